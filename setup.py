@@ -11,7 +11,12 @@ setup(
     author_email="wouter@evenflow.nl",
     description="csshX like ssh tool for iTerm2",
     url="http://github.com/wouterdebie/i2cssh",
-    entry_points={"console_scripts": ["i2cssh=i2cssh.main:main"]},
+    entry_points={
+        "console_scripts": [
+            "i2cssh=i2cssh.main:main",
+            "i2cssh-complete=i2cssh.completion:main",
+        ]
+    },
     license="MIT",
     keywords="ssh i2cssh csshX".split(),
     classifiers=[
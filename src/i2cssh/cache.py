@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Caches of i2cssh. These are used on paths that have to be fast, like shell completion, so this
+module only imports what it needs when it needs it.
+"""
+
+import os
+
+
+def get_file_key(path):
+    """Returns the mtime and size of a file, or None if it can't be read"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def get_config_key():
+    """
+    Returns a string that changes whenever the config file or any of the files in the config
+    directory changes.
+    """
+    config_file = os.path.expanduser("~/.i2csshrc")
+    config_dir = os.path.expanduser("~/.i2csshrc.d")
+    paths = [config_file]
+    try:
+        paths += [
+            os.path.join(config_dir, name) for name in sorted(os.listdir(config_dir))
+        ]
+    except OSError:
+        pass
+    return "\t".join(f"{path}:{get_file_key(path)}" for path in paths)
+
+
+def get_cache_dir():
+    """Returns the directory the caches of i2cssh are stored in"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "i2cssh")
+
+
+def read_cache_file(name):
+    """Returns the contents of a cache file, or None if it doesn't exist or can't be read"""
+    try:
+        with open(os.path.join(get_cache_dir(), name), "rb") as stream:
+            return stream.read()
+    except OSError:
+        return None
+
+
+def write_cache_file(name, data):
+    """
+    Write the contents of a cache file. The file is replaced atomically, so concurrent runs never
+    see a partially written cache. Not being able to write the cache isn't an error.
+    """
+    import tempfile
+
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=f".{name}.")
+        try:
+            with os.fdopen(fd, "wb") as stream:
+                stream.write(data)
+            os.replace(tmp_file, os.path.join(cache_dir, name))
+        except OSError:
+            os.unlink(tmp_file)
+            raise
+    except OSError:
+        pass
+
+
+def read_cache(name):
+    """Read a cached value. Returns None if it's not cached or the cache can't be read"""
+    import pickle
+
+    data = read_cache_file(name)
+    try:
+        return pickle.loads(data) if data else None
+    except Exception:
+        return None
+
+
+def write_cache(name, value):
+    """Write a value to the cache"""
+    import pickle
+
+    try:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except pickle.PicklingError:
+        return
+    write_cache_file(name, data)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shell completion for cluster names. Completion has to be fast, so names are answered from an
+index in the cache and neither click nor the config parser is loaded unless the index has to
+be built.
+"""
+
+import os
+import sys
+from bisect import bisect_left
+
+from i2cssh.cache import get_config_key, read_cache_file, write_cache_file
+
+CLUSTER_NAMES_CACHE = "cluster-names"
+
+BASH_SCRIPT = """\
+_i2cssh() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}"
+    if [[ "$prev" == "-c" || "$prev" == "--clusters" ]] || [[ "$cur" != -* && "$prev" != -* ]]; then
+        COMPREPLY=($(i2cssh-complete -- "$cur"))
+    fi
+}
+complete -o default -F _i2cssh i2cssh
+"""
+
+ZSH_SCRIPT = """\
+_i2cssh() {
+    local cur="${words[CURRENT]}" prev="${words[CURRENT-1]}"
+    if [[ "$prev" == (-c|--clusters) ]] || [[ "$cur" != -* && "$prev" != -* ]]; then
+        compadd -U -- ${(f)"$(i2cssh-complete -- "$cur")"}
+    else
+        _files
+    fi
+}
+compdef _i2cssh i2cssh
+"""
+
+SCRIPTS = {"bash": BASH_SCRIPT, "zsh": ZSH_SCRIPT}
+
+
+def main(argv=None):
+    """
+    Usage: i2cssh-complete [--] WORD      print the completions for WORD
+           i2cssh-complete --shell SHELL  print the completion script for bash or zsh
+    """
+    args = sys.argv[1:] if argv is None else argv
+
+    if len(args) == 2 and args[0] == "--shell" and args[1] in SCRIPTS:
+        sys.stdout.write(SCRIPTS[args[1]])
+        return
+    if args == ["--refresh"]:
+        refresh_cluster_names()
+        return
+
+    if args[:1] == ["--"]:
+        args = args[1:]
+    if len(args) > 1:
+        print(main.__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+    sys.stdout.write("".join(f"{name}\n" for name in complete(args[0] if args else "")))
+
+
+def complete(word):
+    """
+    Returns the cluster names that complete word. For a comma separated list of clusters (as
+    used by -c), only the last cluster is completed.
+    """
+    head, comma, prefix = word.rpartition(",")
+    names = get_cluster_names()
+
+    # Names are sorted, so all names that start with prefix follow each other
+    completions = []
+    for name in names[bisect_left(names, prefix) :]:
+        if not name.startswith(prefix):
+            break
+        completions.append(f"{head}{comma}{name}")
+    return completions
+
+
+def get_cluster_names():
+    """
+    Returns the sorted cluster names from the index. If the config changed since the index was
+    built, the names in the index are still used, but the index is refreshed in the background.
+    Only a missing index is built right away.
+    """
+    key = get_config_key()
+    data = read_cache_file(CLUSTER_NAMES_CACHE)
+    if data is None:
+        return refresh_cluster_names(key)
+
+    cached_key, _, names = data.decode().partition("\n")
+    if cached_key != key:
+        refresh_in_background()
+    return names.split("\n") if names else []
+
+
+def refresh_cluster_names(key=None):
+    """Build the index of cluster names from the config and return the names"""
+    import contextlib
+
+    from i2cssh.lib import read_config, read_config_dir
+
+    # The key is taken before reading the config, so changes made while reading the config
+    # are picked up by the next completion.
+    if key is None:
+        key = get_config_key()
+
+    # Errors in the config are for i2cssh itself to report. An invalid config has no names,
+    # which are still written, so the config isn't read again until it changes.
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            clusters = set((read_config() or {}).get("clusters") or {})
+            clusters.update(read_config_dir() or {})
+    except SystemExit:
+        clusters = set()
+
+    names = sorted(str(name) for name in clusters)
+    write_cache_file(CLUSTER_NAMES_CACHE, "\n".join([key] + names).encode())
+    return names
+
+
+def refresh_in_background():
+    """Refresh the index of cluster names in a separate process"""
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, "-m", "i2cssh.completion", "--refresh"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
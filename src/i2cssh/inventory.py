@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dynamic inventories for clusters whose hosts come from running a command. The hosts a command
+prints are cached, so a launch only waits for a command whose hosts have never been cached.
+Hosts that are older than their TTL are still used, while the command runs again in the
+background to refresh them for the next launch.
+
+An inventory source is a tuple of its kind and the command to run. The kind determines how the
+output of the command is turned into hosts:
+
+- command: every line is a host (hosts_command in a cluster)
+- kubernetes: the pods that kubectl lists as JSON (kubernetes in a cluster)
+"""
+
+import hashlib
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+from i2cssh.cache import get_cache_dir, read_cache, write_cache
+
+# Number of seconds the hosts of a source are fresh, if the cluster doesn't set cache_ttl.
+# Pods come and go, so they're only cached for a short time.
+DEFAULT_TTLS = {"command": 300, "kubernetes": 30}
+
+# Number of seconds after which a background refresh that never finished is given up on, so
+# the next launch can start another one
+REFRESH_TIMEOUT = 300
+
+
+class InventoryError(Exception):
+    """Raised when an inventory command fails and there are no cached hosts to fall back on"""
+
+    def __init__(self, command, error):
+        super().__init__(f"Inventory command '{command}' failed: {error}")
+        self.command = command
+
+
+def get_source(cluster):
+    """Returns the inventory source of a cluster, or None if its hosts are all in the config"""
+    if command := cluster.get("hosts_command"):
+        return ("command", command)
+    if kubernetes := cluster.get("kubernetes"):
+        return ("kubernetes", get_kubectl_command(kubernetes))
+    return None
+
+
+def get_kubectl_command(kubernetes):
+    """
+    Returns the kubectl command that lists the pods for the kubernetes section of a cluster,
+    which has a namespace, a label selector and optionally a context.
+    """
+    command = ["kubectl", "get", "pods", "-o", "json"]
+    if context := kubernetes.get("context"):
+        command += ["--context", context]
+    if namespace := kubernetes.get("namespace"):
+        command += ["--namespace", namespace]
+    if selector := kubernetes.get("selector"):
+        command += ["--selector", selector]
+    return shlex.join(command)
+
+
+def get_inventory_hosts(sources):
+    """
+    Returns the host strings for a dict of inventory sources and their TTLs. Sources that
+    have never been cached are run concurrently, all other sources are answered from the
+    cache and only refreshed in the background if they're stale.
+    """
+    host_strings = {}
+    missing = []
+    for source, ttl in sources.items():
+        cached = read_cache(get_cache_name(source))
+        if cached is None:
+            missing.append(source)
+            continue
+
+        updated, host_strings[source] = cached
+        if time.time() - updated >= ttl:
+            refresh_in_background(source)
+
+    host_strings.update(run_sources(missing))
+    return host_strings
+
+
+def get_cache_name(source):
+    """Returns the name of the cache file for the hosts of a source"""
+    key = "\0".join(source).encode()
+    return f"inventory-{hashlib.sha256(key).hexdigest()[:16]}.pickle"
+
+
+def run_sources(sources):
+    """
+    Run the commands of inventory sources concurrently and cache their hosts. Returns a dict
+    with the host strings per source. Once a command fails, the commands that are still running
+    are killed and the InventoryError is raised, but the hosts of the commands that succeeded
+    are still cached.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    # All commands are started before waiting for any of them. Every command gets its own
+    # process group, so killing it also kills the processes it started.
+    processes = {
+        source: subprocess.Popen(
+            source[1],
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True,
+        )
+        for source in sources
+    }
+    if not processes:
+        return {}
+
+    host_strings = {}
+    failure = None
+    # The output of every command is read in its own thread. A command that writes more than
+    # fits in its pipe would otherwise block until the commands before it are done.
+    with ThreadPoolExecutor(max_workers=len(processes)) as executor:
+        futures = {
+            executor.submit(process.communicate): source
+            for source, process in processes.items()
+        }
+        for future in as_completed(futures):
+            source = futures[future]
+            output, error = future.result()
+            try:
+                host_strings[source] = parse_output(
+                    source, processes[source].returncode, output, error
+                )
+            except InventoryError as exc:
+                # Commands that fail because they're killed aren't the cause
+                if failure is None:
+                    failure = exc
+                    for process in processes.values():
+                        kill(process)
+                continue
+            write_cache(get_cache_name(source), (time.time(), host_strings[source]))
+
+    if failure:
+        raise failure
+    return {source: host_strings[source] for source in sources}
+
+
+def parse_output(source, returncode, output, error):
+    """Returns the host strings in the output of the command of a source"""
+    if returncode != 0:
+        raise InventoryError(source[1], error.strip() or f"exit status {returncode}")
+    return PARSERS[source[0]](source[1], output)
+
+
+def kill(process):
+    """Kill a command and the processes it started, unless it's already done"""
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def parse_host_line(line):
+    """Returns the host string on a line of a host file, or None for blank lines and comments"""
+    line = line.strip()
+    if line and not line.startswith("#"):
+        return line
+    return None
+
+
+def parse_lines(command, output):
+    """Every line is a host, except for blank lines and comments"""
+    return [
+        host_string
+        for line in output.splitlines()
+        if (host_string := parse_host_line(line))
+    ]
+
+
+def parse_pods(command, output):
+    """
+    Returns the names of the pods in the JSON output of kubectl. Pods that aren't running or
+    are being deleted can't be connected to, so they're skipped.
+    """
+    try:
+        pods = json.loads(output)["items"]
+    except (ValueError, KeyError, TypeError) as exc:
+        raise InventoryError(command, f"invalid output ({exc})")
+
+    return [
+        pod["metadata"]["name"]
+        for pod in pods
+        if pod.get("status", {}).get("phase") == "Running"
+        and not pod["metadata"].get("deletionTimestamp")
+    ]
+
+
+PARSERS = {"command": parse_lines, "kubernetes": parse_pods}
+
+
+def refresh_in_background(source):
+    """
+    Run the command of an inventory source in a separate process that outlives i2cssh. Only
+    one refresh of a source runs at a time.
+    """
+    if not start_refresh(source):
+        return
+    subprocess.Popen(
+        [sys.executable, "-m", "i2cssh.inventory", *source],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def get_refresh_marker(source):
+    """Returns the path of the file that marks a refresh of a source as running"""
+    return os.path.join(get_cache_dir(), f"{get_cache_name(source)}.refresh")
+
+
+def start_refresh(source):
+    """
+    Mark a refresh of a source as running. Returns False if another refresh is already
+    running, unless it started more than REFRESH_TIMEOUT seconds ago.
+    """
+    marker = get_refresh_marker(source)
+    try:
+        os.makedirs(get_cache_dir(), exist_ok=True)
+    except OSError:
+        return True
+
+    for _ in range(2):
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(marker) < REFRESH_TIMEOUT:
+                    return False
+                os.unlink(marker)
+            except OSError:
+                pass
+        except OSError:
+            # Without a marker, refreshes just aren't deduplicated
+            return True
+    return False
+
+
+def main(argv=None):
+    """Refresh the cached hosts of the inventory source given as KIND COMMAND"""
+    kind, command = sys.argv[1:] if argv is None else argv
+
+    # A failing command keeps its stale hosts until the next refresh
+    try:
+        run_sources([(kind, command)])
+    except InventoryError:
+        sys.exit(1)
+    finally:
+        try:
+            os.unlink(get_refresh_marker((kind, command)))
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,26 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import copy
+import functools
+import itertools
 import math
 import os
 import re
 import sys
+import time
+from collections import ChainMap
+from collections.abc import Mapping
 
 import click
-import iterm2
-import shellingham
-import yaml
 from click_option_group import MutuallyExclusiveOptionGroup, optgroup
-from iterm2 import Session
-from iterm2.color import Color
-from iterm2.profile import LocalWriteOnlyProfile
 
+from i2cssh.cache import (
+    get_cache_dir,
+    get_config_key,
+    get_file_key,
+    read_cache,
+    write_cache,
+)
 from i2cssh.version import version
 
 EXIT_CODE_NO_HOSTS = 255
@@ -22,11 +28,85 @@ EXIT_CODE_UNKNOWN_CLUSTER = 254
 EXIT_CODE_NO_CURRENT_WINDOW = 253
 EXIT_CODE_INVALID_YAML = 252
 EXIT_CODE_NO_CLUSTERS = 251
+EXIT_CODE_INCLUDE_CYCLE = 250
+EXIT_CODE_INVALID_SELECTION = 249
+EXIT_CODE_INVENTORY_FAILED = 248
+EXIT_CODE_INVALID_PATTERN = 247
+EXIT_CODE_TOO_MANY_HOSTS = 246
+
+CONFIG_CACHE = "config.pickle"
+CONFIG_DIR_CACHE = "config.d.pickle"
+CONFIG_DIR_EXTENSIONS = (".yml", ".yaml")
+INDEX_CACHE = "index-{}.pickle"
+
+# Maximum number of panes that commands are sent to at the same time
+DEFAULT_CONCURRENCY = 32
+
+# Maximum number of hosts a single host string can expand to. Nobody can work with that many
+# panes, so anything bigger is most likely a typo in a range.
+MAX_EXPANSION = 4096
+
+# The ways booleans and null can be written in tags and selections, and how they're compared
+YAML_CONSTANTS = {
+    "true": "true",
+    "false": "false",
+    "null": "null",
+    "none": "null",
+    "~": "null",
+}
+
+# Number of seconds to wait for the ssh port of a host with --probe, and the maximum number of
+# hosts that are probed at the same time. Every probe takes a file descriptor, and macOS only
+# allows 256 by default.
+DEFAULT_PROBE_TIMEOUT = 2
+PROBE_CONCURRENCY = 128
+
+# Number of unreachable hosts that are listed by name when they're skipped
+PROBE_SUMMARY_HOSTS = 10
+
+# With --prewarm, the number of seconds to wait for all ControlMaster connections to be set up
+# and the number of seconds they stay open after the last session using them has closed
+PREWARM_TIMEOUT = 10
+CONTROL_PERSIST = 600
+
+# Options for ssh to open a ControlMaster connection and go to the background once it's up
+MASTER_OPTIONS = (
+    f"-o ControlMaster=auto -o ControlPersist={CONTROL_PERSIST} -o BatchMode=yes -N -f"
+)
 
-try:
-    current_shell = shellingham.detect_shell()[0]
-except shellingham.ShellDetectionFailure:
-    current_shell = "zsh"
+# Extra ssh options and -o config options for forwards and ttys, which are left out of the
+# command that opens a ControlMaster connection
+MASTER_SKIPPED_OPTIONS = {"A", "D", "L", "R", "W", "X", "Y", "t", "tt", "T"}
+MASTER_SKIPPED_CONFIG = {
+    "dynamicforward",
+    "forwardagent",
+    "forwardx11",
+    "forwardx11trusted",
+    "localforward",
+    "remoteforward",
+    "requesttty",
+}
+
+# Number of SSH sessions started per second in adaptive mode, if no rate is set
+DEFAULT_RATE = 10
+
+# In adaptive mode, the rate never drops below this fraction of the configured rate
+ADAPTIVE_MIN_RATE = 0.05
+
+# In adaptive mode, the number of seconds a session is watched for throttling errors and
+# the number of times it's restarted if it's throttled
+ADAPTIVE_WATCH_TIME = 3
+ADAPTIVE_RETRIES = 3
+
+# Errors that ssh shows when a server (or bastion) refuses connections, for example because
+# MaxStartups is reached
+THROTTLING_ERRORS = (
+    "Connection refused",
+    "Connection reset by peer",
+    "Connection closed by",
+    "kex_exchange_identification",
+    "ssh_exchange_identification",
+)
 
 
 @click.command()
@@ -36,13 +116,30 @@ except shellingham.ShellDetectionFailure:
     "-c",
     "cli_clusters",
     multiple=False,
-    help="Comma-separated list of clusters specified in ~/.i2csshrc",
+    help="Comma-separated list of clusters specified in ~/.i2csshrc. Clusters can be glob or /regex/ patterns",
 )
 @optgroup.option(
-    "--machines", "-m", multiple=False, help="Comma-separated list of hosts"
+    "--machines",
+    "-m",
+    multiple=False,
+    help="Comma-separated list of hosts. Glob or /regex/ patterns select hosts from all clusters",
 )
 @optgroup.option(
-    "--file", "-f", multiple=False, help="Cluster file (one hostname per line)"
+    "--file",
+    "-f",
+    multiple=False,
+    help="Cluster file (one hostname per line, - for stdin)",
+)
+@optgroup.option(
+    "--max-hosts",
+    multiple=False,
+    type=int,
+    help="Read at most this many hosts from --file. Panes are created right away and connect as host lines arrive",
+)
+@optgroup.option(
+    "--select",
+    multiple=False,
+    help="Select hosts from all clusters by their tags, e.g. 'role=db and dc=ams'",
 )
 @optgroup.option(
     "--tab-split",
@@ -97,7 +194,13 @@ except shellingham.ShellDetectionFailure:
     "--gateway",
     "-g",
     multiple=False,
-    help="Multihop SSH connection gateway string (e.g. username@gateway) - usually used with -A",
+    help="Multihop SSH connection gateway string (e.g. username@gateway, or hop1,hop2 for multiple hops) - usually used with -A",
+)
+@optgroup.option(
+    "--gateway-mux",
+    is_flag=True,
+    default=False,
+    help="Open a single multiplexed connection per gateway and connect all hosts through it",
 )
 @optgroup.option(
     "--custom-command",
@@ -105,6 +208,24 @@ except shellingham.ShellDetectionFailure:
     multiple=False,
     help='Custom command to run instead of SSH. Use "{host}" to for host substitution (e.g. "kubectl exec -it {host} -- /bin/bash")',
 )
+@optgroup.option(
+    "--prewarm",
+    is_flag=True,
+    default=False,
+    help="Open ssh ControlMaster connections to all hosts concurrently before opening the panes, so every pane connects right away",
+)
+@optgroup.option(
+    "--probe",
+    is_flag=True,
+    default=False,
+    help="Skip hosts whose ssh port can't be reached, before the layout is computed",
+)
+@optgroup.option(
+    "--probe-timeout",
+    multiple=False,
+    type=float,
+    help=f"Number of seconds to wait for the ssh port of a host with --probe (default: {DEFAULT_PROBE_TIMEOUT})",
+)
 @optgroup.group("iTerm2 options")
 @optgroup.option("--fullscreen", "-F", is_flag=True, help="Make the window fullscreen")
 @optgroup.option(
@@ -124,14 +245,46 @@ except shellingham.ShellDetectionFailure:
     "--sleep",
     "-s",
     multiple=False,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Number of seconds to sleep between creating SSH sessions (same as --rate 1/SLEEP)",
+)
+@optgroup.option(
+    "--rate",
+    multiple=False,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of SSH sessions to start per second",
+)
+@optgroup.option(
+    "--burst",
+    multiple=False,
+    type=click.IntRange(min=1),
+    help="Number of SSH sessions that can start at once before --rate applies (default: 1)",
+)
+@optgroup.option(
+    "--adaptive",
+    is_flag=True,
+    default=False,
+    help=f"Slow down when connections are refused or throttled and retry them (default rate: {DEFAULT_RATE}/s)",
+)
+@optgroup.option(
+    "--concurrency",
+    "-j",
+    multiple=False,
     type=int,
-    help="Number of seconds to sleep between creating SSH sessions",
+    help=f"Maximum number of SSH sessions to start concurrently (default: {DEFAULT_CONCURRENCY})",
+)
+@optgroup.option(
+    "--prompt-timeout",
+    "-w",
+    multiple=False,
+    type=float,
+    help="Wait up to this many seconds for the shell prompt in each pane before sending commands",
 )
 @optgroup.option(
     "--shell",
     "-S",
     multiple=False,
-    help=f"Shell to use when spawning the SSH sessions (default: {current_shell})",
+    help="Shell to use when spawning the SSH sessions (default: the current shell)",
 )
 @optgroup.option(
     "--exec",
@@ -140,6 +293,33 @@ except shellingham.ShellDetectionFailure:
     default=False,
     help="Use exec when spawning ssh. This will close the pane when ssh exits",
 )
+@optgroup.option(
+    "--direct",
+    "-D",
+    is_flag=True,
+    default=False,
+    help="Start ssh directly in each pane instead of typing it into a login shell. This will close the pane when ssh exits",
+)
+@optgroup.option(
+    "--stats",
+    is_flag=True,
+    default=False,
+    help="Print the launch time and the number of iTerm2 requests and round trips",
+)
+@optgroup.option(
+    "--fill-unused",
+    "-U",
+    is_flag=True,
+    default=False,
+    help="Fill up incomplete grids with UNUSED panes instead of making the panes in the last row wider",
+)
+@optgroup.option(
+    "--progressive",
+    "-P",
+    is_flag=True,
+    default=False,
+    help="Make panes usable as soon as they're connected, while the rest is still being built",
+)
 @optgroup.group("Layout", cls=MutuallyExclusiveOptionGroup)
 @optgroup.option(
     "--columns",
@@ -175,12 +355,34 @@ def app(hosts_or_cluster, *_args, **cmdline_opts):
         print(version())
         sys.exit(0)
 
+    # Planning the launch doesn't need iTerm2, so it's done in a separate thread while the
+    # connection to iTerm2 is being set up.
+    planning = plan_in_background(hosts_or_cluster, cmdline_opts)
+
+    # Execute the SSH sessions
+    import iterm2
+
+    try:
+        iterm2.run_until_complete(exec_in_iterm(planning, cmdline_opts))
+    finally:
+        # Errors in planning take precedence, even if the connection to iTerm2 failed
+        planning.result()
+
+
+def plan(hosts_or_cluster, cmdline_opts):
+    """
+    Plan the launch: read the config, resolve the hosts and their options and compute the
+    geometry of every group. Returns the groups and the global options.
+    """
     # Keep track of valid command line options so we can filter out
     # additional options in the config file
     valid_options = list(cmdline_opts.keys())
 
     # Load config file and get valid options. Since command line options take precedence, we
     # override the config file options with the command line options.
+    # The key of the config files is taken before reading them, so the indexes of the clusters
+    # are built again if the files change while they're read
+    cache_key = get_config_key()
     config = read_config()
     if config:
         global_opts = filter_valid_options(config, valid_options)
@@ -190,20 +392,24 @@ def app(hosts_or_cluster, *_args, **cmdline_opts):
     # Because we can split tabs based on cluster/hosts/arguments we first
     # create different groups inside the hosts list. If it turns out we
     # don't need to split tabs, we'll just have one group by flattening
-    # the list. Hosts are dictionaries with all the options necessary to spawn the SSH session
+    # the list. Hosts look up all the options necessary to spawn the SSH session
     groups = []
 
+    # Clusters are resolved through an index, so includes that are shared by several clusters
+    # are only resolved once
+    cluster_index = ClusterIndex(config, read_config_dir(), cache_key)
+
     # If there's only one argument, we assume it's a cluster name (since there's
     # no need to use i2cssh for a single host) and we get hosts from the cluster
     # configuration. Otherwise we construct a list of hosts from the arguments.
     if len(hosts_or_cluster) == 1:
         # Single cluster, so we know there's only one list returned
         groups = get_clusters_from_cluster_names(
-            [hosts_or_cluster[0]], config, valid_options
+            [hosts_or_cluster[0]], cluster_index, valid_options
         )
     # More than one argument, so we assume it's a list of hosts
     elif len(hosts_or_cluster) > 1:
-        hosts = get_hosts(hosts_or_cluster)
+        hosts = get_hosts(hosts_or_cluster, cluster_index)
         # If tab_split is defined, hosts get separate tabs, otherwise we put all
         # hosts defined as arguments in one group
         if cmdline_opts.get("tab_split") or global_opts.get("tab_split"):
@@ -216,7 +422,7 @@ def app(hosts_or_cluster, *_args, **cmdline_opts):
     # from those clusters as well.
     if cmdline_opts.get("cli_clusters"):
         clusters = get_clusters_from_cluster_names(
-            cmdline_opts.get("cli_clusters").split(","), config, valid_options
+            split_list(cmdline_opts.get("cli_clusters")), cluster_index, valid_options
         )
         for cluster in clusters:
             groups.append(cluster)
@@ -229,39 +435,48 @@ def app(hosts_or_cluster, *_args, **cmdline_opts):
         if cmdline_opts.get("tab_split_nogroup") or global_opts.get(
             "tab_split_nogroup"
         ):
-            for m in cmdline_opts.get("machines").split(","):
-                groups.append(get_hosts([m]))
+            for m in split_list(cmdline_opts.get("machines")):
+                groups.append(get_hosts([m], cluster_index))
         else:
-            groups.append(get_hosts(cmdline_opts.get("machines").split(",")))
+            groups.append(
+                get_hosts(split_list(cmdline_opts.get("machines")), cluster_index)
+            )
 
+    # The command line option '--select' selects hosts from all clusters by their tags
+    if selection := cmdline_opts.get("select"):
+        groups.append(select_hosts(selection, cluster_index, valid_options))
+
+    # Hosts from '-f' can be read while the launch is already going on, but only if the number
+    # of panes is known up front. In direct mode the command of a pane has to be known when the
+    # pane is created, so the whole file is read first.
+    stream = None
     if filename := cmdline_opts.get("file"):
-        groups.append(get_hosts(get_host_strs_from_file(filename)))
+        max_hosts = cmdline_opts.get("max_hosts") or global_opts.get("max_hosts")
+        if max_hosts and not (cmdline_opts.get("direct") or global_opts.get("direct")):
+            stream = HostStream(click.open_file(filename), max_hosts, cluster_index)
+        else:
+            host_strs = get_host_strs_from_file(filename)
+            groups.append(get_hosts(host_strs, cluster_index, max_hosts))
 
     # Each host might have additional options based on cluster config
     # or login@host syntax. We need to merge those options with the
     # global options specified in the config file and on the command line.
     #
-    # Precedence is: global config < cluster config < host config < command line,
-    # so we need to apply the options in that order.
-
-    for hosts in groups:
-        for host in hosts:
-            # Save login in order to apply it later
-            login = host.get("login")
-
-            if config:
-                apply_opts(host, global_opts, valid_options)
-
-            # Apply cluster options from config file
-            apply_opts(host, host["cluster_options"], valid_options)
-            host.pop("cluster_options")
-
-            # Apply login from host config we saved it
-            if login:
-                host["login"] = login
+    # Precedence is: global config < cluster config < host config < command line.
+    # Hosts only hold their hostname and login; the other layers are merged once per
+    # cluster and shared by all hosts of that cluster.
+    # Hosts that are read from a stream later on get the options of its template
+    layer_options(
+        groups + ([[stream.template]] if stream else []),
+        global_opts if config else {},
+        cmdline_opts,
+        valid_options,
+    )
 
-            # Apply options from command line
-            apply_opts(host, cmdline_opts, valid_options)
+    # Hosts that can't be reached don't get a pane
+    if cmdline_opts.get("probe") or global_opts.get("probe"):
+        timeout = cmdline_opts.get("probe_timeout") or global_opts.get("probe_timeout")
+        groups = skip_unreachable(groups, timeout or DEFAULT_PROBE_TIMEOUT)
 
     # Flatten the list if we don't need to split tabs. We create a single
     # group though, so we can still use the same code to calculate geometry
@@ -274,50 +489,239 @@ def app(hosts_or_cluster, *_args, **cmdline_opts):
     ):
         groups = [flatten(groups)]
 
-    # Bail if we don't have any hosts
-    if len(flatten(groups)) == 0:
+        # The hosts from the stream come after all other hosts in the same group
+        if stream:
+            stream.hosts = groups.pop()
+
+    if stream:
+        groups.append(stream)
+
+    # Bail if we don't have any hosts. A stream might still get its hosts later on.
+    if not stream and len(flatten(groups)) == 0:
         click.echo("No hosts found")
         sys.exit(EXIT_CODE_NO_HOSTS)
 
-    # Attach a geometry and group options to each group. Here we take options the first host, since
-    # we assume that all hosts in a group have the same group options. Also, we set a few defaults.
-    groups = [
-        {
-            "hosts": hosts,
-            "geometry": compute_geometry(
-                len(hosts), hosts[0].get("rows"), hosts[0].get("columns")
-            ),
-            "profile": hosts[0].get("profile", "Default"),
-            "shell": hosts[0].get("shell", current_shell),
-            "broadcast": hosts[0].get("broadcast"),
-            "nobroadcast": hosts[0].get("nobroadcast"),
-            "direction": hosts[0].get("direction"),
-        }
-        for hosts in groups
+    # Attach a geometry and group options to each group
+    groups = [create_group(hosts) for hosts in groups]
+
+    return groups, global_opts
+
+
+def skip_unreachable(groups, timeout):
+    """
+    Probe the hosts of all groups and return the groups without the hosts that can't be
+    reached. Groups that don't have any hosts left are dropped. The skipped hosts are listed.
+    """
+    all_hosts = flatten(groups)
+    reachable = asyncio.run(probe_hosts(all_hosts, timeout))
+
+    unreachable = [
+        get_host_str(host) for host, ok in zip(all_hosts, reachable) if not ok
     ]
+    if unreachable:
+        skipped = ", ".join(unreachable[:PROBE_SUMMARY_HOSTS])
+        if len(unreachable) > PROBE_SUMMARY_HOSTS:
+            skipped += f" and {len(unreachable) - PROBE_SUMMARY_HOSTS} more"
+        click.echo(
+            f"Skipping {len(unreachable)} unreachable hosts: {skipped}", err=True
+        )
 
-    # Execute the SSH sessions
-    iterm2.run_until_complete(exec_in_iterm(groups, cmdline_opts, global_opts))
+    # The results are in the order of the hosts of all groups
+    results = iter(reachable)
+    groups = [[host for host in hosts if next(results)] for hosts in groups]
+    return [hosts for hosts in groups if hosts]
+
+
+async def probe_hosts(hosts, timeout, concurrency=PROBE_CONCURRENCY):
+    """
+    Returns for every host whether its ssh port accepts connections within timeout seconds.
+    The address and port are resolved by ssh -G, so a HostName or Port in ~/.ssh/config is
+    probed just like ssh would connect to it. Hosts are resolved and probed concurrently, at
+    most concurrency at a time, and every address is only probed once.
+
+    Hosts that ssh reaches through a gateway, ProxyJump or ProxyCommand, or with a custom
+    command, can't be probed from here, so they count as reachable.
+    """
+    import subprocess
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve(command, host):
+        async with semaphore:
+            try:
+                process = await asyncio.create_subprocess_shell(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+                output, _ = await process.communicate()
+            except OSError:
+                output = None
+        # Without ssh -G, the hostname and port are probed as they are
+        if not output or process.returncode != 0:
+            return host["hostname"], get_ssh_port(host)
+        return get_ssh_target(output.decode())
+
+    async def probe(hostname, port):
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(hostname, port), timeout
+                )
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            return True
+
+    commands = [
+        (
+            None
+            if host.get("gateway") or host.get("custom_command")
+            else get_resolve_command(host)
+        )
+        for host in hosts
+    ]
+    unique = {command: host for command, host in zip(commands, hosts) if command}
+    resolved = await asyncio.gather(*[resolve(c, h) for c, h in unique.items()])
+    targets = dict(zip(unique, resolved))
+    targets = [targets[command] if command else None for command in commands]
+
+    unique = list(dict.fromkeys(target for target in targets if target))
+    probes = dict(zip(unique, await asyncio.gather(*[probe(*t) for t in unique])))
+    return [probes[target] if target else True for target in targets]
+
+
+def get_resolve_command(host):
+    """Returns the ssh -G command that prints the config ssh uses to connect to a host"""
+    ssh_prefix = create_ssh_prefix(host.get("forward_agent"), host.get("extra"), None)
+    return re.sub(" +", " ", f"{ssh_prefix} -G {get_host_str(host)}")
+
+
+def get_ssh_target(config):
+    """
+    Returns the hostname and port in the output of ssh -G, or None if ssh connects through a
+    ProxyJump or ProxyCommand
+    """
+    options = {}
+    for line in config.splitlines():
+        key, _, value = line.partition(" ")
+        options.setdefault(key.lower(), value.strip())
+
+    if any(options.get(key, "none") != "none" for key in ("proxyjump", "proxycommand")):
+        return None
+    return options.get("hostname"), int(options.get("port", 22))
+
+
+def get_ssh_port(host):
+    """Returns the port ssh connects to for a host, which can be set with the extra option p"""
+    extra = host.get("extra") or {}
+    if isinstance(extra, dict):
+        return int(extra.get("p", 22))
+
+    port = 22
+    for e in extra:
+        k, _, v = e.partition("=")
+        if k == "p" and v:
+            port = int(v)
+    return port
+
+
+def create_group(hosts):
+    """
+    Create a group for a list of hosts, with a geometry and the group options. Here we take the
+    options of the first host, since we assume that all hosts in a group have the same group
+    options. Also, we set a few defaults.
+    """
+    if isinstance(hosts, HostStream) and not hosts.hosts:
+        # None of the hosts of a stream have been read yet, but they all get its options
+        first = hosts.template
+    else:
+        first = hosts[0]
+
+    return {
+        "hosts": hosts,
+        "geometry": compute_geometry(
+            len(hosts), first.get("rows"), first.get("columns")
+        ),
+        "profile": first.get("profile", "Default"),
+        "shell": first.get("shell") or default_shell(),
+        "broadcast": first.get("broadcast"),
+        "nobroadcast": first.get("nobroadcast"),
+        "direction": first.get("direction"),
+        "rows": first.get("rows"),
+        "concurrency": first.get("concurrency"),
+        "direct": first.get("direct"),
+        "prompt_timeout": first.get("prompt_timeout"),
+        "fill_unused": first.get("fill_unused"),
+        "sleep": first.get("sleep"),
+        "rate": first.get("rate"),
+        "burst": first.get("burst"),
+        "adaptive": first.get("adaptive"),
+    }
+
+
+def plan_in_background(hosts_or_cluster, cmdline_opts):
+    """
+    Plan the launch in a separate thread. Returns a future with the groups, the global options
+    and the time planning took.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def timed_plan():
+        started = time.monotonic()
+        groups, global_opts = plan(hosts_or_cluster, cmdline_opts)
+        return groups, global_opts, time.monotonic() - started
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    planning = executor.submit(timed_plan)
+    executor.shutdown(wait=False)
+    return planning
 
 
-def exec_in_iterm(groups, cmdline_opts, global_opts):
+def exec_in_iterm(planning, cmdline_opts):
     """
     Execute the SSH sessions in iTerm2
-    This function takes in groups of hosts and global options and returns an
-    async function that will be executed by iTerm2
+    This function takes in a future with the planned groups of hosts and global options and
+    returns an async function that will be executed by iTerm2
     """
+    started = time.monotonic()
 
     async def inner(connection):
-        window = await get_window(connection)
+        # Requests are only counted when stats are wanted, since that wraps the connection.
+        # If they're only enabled in the config, counting starts once the config is read.
+        stats = LaunchStats()
+        if cmdline_opts.get("stats"):
+            stats.track(connection)
+
+        async def handshake():
+            window = await get_window(connection)
+            return window, time.monotonic() - started
+
+        # Fetch the current window while planning is still going on
+        (window, handshake_time), (groups, global_opts, plan_time) = (
+            await asyncio.gather(handshake(), asyncio.wrap_future(planning))
+        )
+        stats.saved = min(handshake_time, plan_time)
+        if global_opts.get("stats") and not cmdline_opts.get("stats"):
+            stats.track(connection)
+
         # Bail if we're not inside iterm
         if window is None:
             click.echo("No current window")
             sys.exit(EXIT_CODE_NO_CURRENT_WINDOW)
 
-        # Keep track of broadcast domains. This is later used to tell iTerm2 which tabs need to
-        # have keyboard broadcasting enabled.
-        broadcast_domains = []
+        # ControlMaster connections are opened in the background while the layout is built.
+        # Every pane only waits for the connection of its own host before starting its session.
+        masters = open_control_masters(
+            flatten([group["hosts"] for group in groups]),
+            cmdline_opts.get("concurrency") or global_opts.get("concurrency"),
+        )
 
+        # Create the window and tabs for all groups first. This is done one by one, so the
+        # tabs end up in the same order as the groups.
+        sessions = []
+        group_lwops = []
         for i, group in enumerate(groups):
             profile_name = group.get("profile")
 
@@ -325,7 +729,20 @@ def exec_in_iterm(groups, cmdline_opts, global_opts):
             # default shell, we add it to a LocalWriteOnlyProfile (lwop) that is then passed in as
             # profile_customizations when creating tabs and panes.
             shell = f"/usr/bin/env {group.get('shell')} -l"
-            lwop = create_lwop(shell)
+            lwops = [create_lwop(shell)] * sum(get_row_counts(group))
+
+            # Panes without a host show UNUSED right away, without starting a shell
+            for p in range(len(group["hosts"]), len(lwops)):
+                lwops[p] = create_unused_lwop()
+
+            # In direct mode every pane with a host gets its own lwop that runs the ssh command
+            # instead of the shell.
+            if group.get("direct"):
+                for p, host_opts in enumerate(group["hosts"]):
+                    lwops[p] = create_lwop(get_direct_command(p, host_opts))
+
+            group_lwops.append(lwops)
+            lwop = lwops[0]
 
             # If this is the first host in the group and we want sessions in a separate window,
             # we create a new window. In any other cases we just create a new tab for the group
@@ -333,8 +750,12 @@ def exec_in_iterm(groups, cmdline_opts, global_opts):
                 cmdline_opts.get("same_window") or global_opts.get("same_window")
             ):
                 window = await create_window(connection, window, profile_name, lwop)
+                tab = window.current_tab
             else:
-                await create_tab(window, profile_name, lwop)
+                tab = await create_tab(window, profile_name, lwop)
+
+            # After creating the tab, the first pane is already there
+            sessions.append(tab.current_session)
 
             # Set window to full screen if necessary
             if (
@@ -344,115 +765,585 @@ def exec_in_iterm(groups, cmdline_opts, global_opts):
             ):
                 await set_fullscreen(window)
 
-            cols = group["geometry"]["cols"]
-            rows = group["geometry"]["rows"]
-
-            if group.get("direction", "") == "row":
-                vertical = False
-                horizontal = True
-            else:
-                vertical = True
-                horizontal = False
+        # Groups with the same rate options share a rate limiter, since they most likely
+        # connect through the same bastions
+        limiters = {}
+        for group in groups:
+            key = get_rate_key(group)
+            if key not in limiters:
+                limiters[key] = create_rate_limiter(group)
+
+        # The concurrency is the number of panes that commands are sent to at the same time,
+        # no matter how many tabs they're in
+        semaphores = {}
+        for group in groups:
+            concurrency = max(group.get("concurrency") or DEFAULT_CONCURRENCY, 1)
+            if concurrency not in semaphores:
+                semaphores[concurrency] = asyncio.Semaphore(concurrency)
+
+        # In progressive mode panes become usable while the rest of the launch is still going
+        progress = None
+        if cmdline_opts.get("progressive") or global_opts.get("progressive"):
+            progress = ProgressiveLaunch(connection, groups)
+
+        # All tabs are independent of each other, so their panes are built concurrently
+        group_panes = await asyncio.gather(
+            *[
+                build_group(
+                    group,
+                    session,
+                    lwops,
+                    limiters[get_rate_key(group)],
+                    on_layout=progress and functools.partial(progress.layout_built, g),
+                    on_started=progress
+                    and functools.partial(progress.session_started, g),
+                    masters=masters,
+                    semaphore=semaphores[
+                        max(group.get("concurrency") or DEFAULT_CONCURRENCY, 1)
+                    ],
+                )
+                for g, (group, session, lwops) in enumerate(
+                    zip(groups, sessions, group_lwops)
+                )
+            ]
+        )
 
-            # List to keep track of panes that are created
-            panes = []
+        # The panes of a stream are closed if the stream ended without any hosts
+        if not any(group_panes):
+            click.echo("No hosts found")
+            sys.exit(EXIT_CODE_NO_HOSTS)
 
-            # After creating the tab, the first pane is already there
-            pane = window.current_tab.current_session
-            panes.append(pane)
-
-            # Split vertically cols-1 times from the last pane
-            # This takes care of the first row
-            for col in range(1, cols):
-                pane = await split_pane(profile_name, lwop, vertical, pane)
-                panes.append(pane)
-
-            # For subsequent rows, we first go back to the first
-            # pane of the row above, then split horizontally
-            for row in range(1, rows):
-                first_col_of_last_row = col_row_to_index(0, row - 1, cols)
-                pane: Session = panes[first_col_of_last_row]
-
-                # Then for each column we split horizontally and jump
-                # to the pane in the next column on the previous row
-                for col in range(cols):
-                    new_pane = await split_pane(profile_name, lwop, horizontal, pane)
-                    panes.append(new_pane)
-                    next_pane = col_row_to_index(col + 1, row - 1, cols)
-                    pane = panes[next_pane]
-
-            # Add panes for this group to a broadcast domain, if the first host specifies
-            # broadcast as an option, UNLESS nobroadcast is set as well.
-            if not group.get("nobroadcast") and group.get("broadcast"):
-                broadcast_domains.append(panes)
-
-            for p, pane in enumerate(panes):
-                # There might be more panes than hosts
-                if p < len(group["hosts"]):
-                    host_opts = group["hosts"][p]
-                    host = get_host_str(host_opts)
-
-                    # If a custom command is specified, execute that and don't care about ssh at all
-                    custom_command = host_opts.get("custom_command")
-                    if custom_command:
-                        # substitute the host name in the custom command
-                        cmd = custom_command.replace("{host}", host).lstrip()
-                        await execute_command(pane, f" unset HISTFILE && {cmd}\n")
-                    else:
-                        env_vars = {}
-                        send_env = ""
-
-                        # Rank is just an env var, so set it if we have it
-                        if host_opts.get("rank"):
-                            env_vars["LC_RANK"] = str(p)
-
-                        # Split other env vars by comma and put them in a dict
-                        if from_env := host_opts.get("environment"):
-                            # if from_env is a dict, assign
-                            if isinstance(from_env, dict):
-                                env_vars = from_env
-                            else:
-                                env_vars.update(
-                                    dict(s.split("=") for s in from_env.split(","))
-                                )
-
-                        # If we have env vars, we export them and set them in the
-                        # ssh options
-                        if len(env_vars) > 0:
-                            (env_vars_str, send_env) = get_env_vars_str(env_vars)
-                            await execute_command(pane, f"{env_vars_str}\n")
-
-                        ssh_prefix = create_ssh_prefix(
-                            host_opts.get("forward_agent"),
-                            host_opts.get("extra"),
-                            host_opts.get("gateway"),
-                        )
-
-                        if host_opts.get("exec"):
-                            # Set ControlMaster=no as a workaround for
-                            # https://gitlab.com/gnachman/iterm2/-/issues/11032
-                            ssh_prefix = f"exec {ssh_prefix} -o ControlMaster=no"
-
-                        if s := host_opts.get("sleep"):
-                            await sleep(s)
-
-                        cmd = f"unset HISTFILE && {ssh_prefix} {send_env} {host}\n"
-                        cmd = re.sub(" +", " ", cmd)
-                        await execute_command(pane, cmd)
-
-                # If we run out of hosts, display an "Unused" pane
-                else:
-                    await create_unused_pane(pane)
+        if progress:
+            # Panes were activated and joined their broadcast domain along the way
+            await progress.finish()
+        else:
+            # Keep track of broadcast domains. This is later used to tell iTerm2 which tabs need
+            # to have keyboard broadcasting enabled.
+            broadcast_domains = [
+                panes
+                for group, panes in zip(groups, group_panes)
+                if panes and broadcasts(group)
+            ]
+
+            # Activate the first pane of every tab, selecting the tab of the last group like it
+            # would have been if the tabs were built one after the other.
+            tabs = [panes for panes in group_panes if panes]
+            await asyncio.gather(
+                *[panes[0].async_activate(select_tab=False) for panes in tabs[:-1]]
+            )
+            await tabs[-1][0].async_activate()
 
-            # Activate first pane
-            await panes[0].async_activate()
+            # Enable broadcast input for all groups that require it
+            await enable_broadcast(connection, broadcast_domains)
 
-        # Enable broadcast input for all groups that require it
-        await enable_broadcast(connection, broadcast_domains)
+        if cmdline_opts.get("stats") or global_opts.get("stats"):
+            click.echo(stats.report(sum(len(panes) for panes in group_panes)), err=True)
 
     return inner
 
 
+def broadcasts(group):
+    """
+    Returns whether broadcast input is enabled for a group. This is the case if the first host
+    specifies broadcast as an option, UNLESS nobroadcast is set as well.
+    """
+    return bool(group.get("broadcast") and not group.get("nobroadcast"))
+
+
+class ProgressiveLaunch:
+    """
+    Makes panes usable while the rest of a launch is still being built. The first pane of a
+    group is activated as soon as the layout of the group is split, and panes join the broadcast
+    domain of their group as soon as their session has started.
+    """
+
+    def __init__(self, connection, groups):
+        self.connection = connection
+        self.groups = groups
+        self.domains = [[] for _ in groups]
+        self.pending = False
+        self.update = None
+
+    async def layout_built(self, g, panes):
+        """Activate the first pane of group g, only selecting the tab of the last group"""
+        await panes[0].async_activate(select_tab=g == len(self.groups) - 1)
+
+    def session_started(self, g, pane):
+        """Add a pane of group g to its broadcast domain"""
+        if not broadcasts(self.groups[g]):
+            return
+        self.domains[g].append(pane)
+        self.pending = True
+        if self.update is None or self.update.done():
+            self.update = asyncio.ensure_future(self.update_broadcast())
+
+    async def update_broadcast(self):
+        # Panes that join while iTerm2 is being updated are sent in the next update, so there's
+        # never more than one update in flight.
+        while self.pending:
+            self.pending = False
+            await enable_broadcast(
+                self.connection, [list(panes) for panes in self.domains if panes]
+            )
+
+    async def finish(self):
+        """Wait for the last broadcast update"""
+        if self.update:
+            await self.update
+        else:
+            await enable_broadcast(self.connection, [])
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the rate at which SSH sessions are started. Up to burst sessions
+    can start right away, after which sessions start at rate sessions per second. If full is
+    False, the bucket starts out empty, so even the first session has to wait.
+
+    In adaptive mode the rate is halved every time a connection is throttled and grows back
+    to the configured rate while connections succeed.
+    """
+
+    def __init__(self, rate, burst=1, full=True, adaptive=False):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.adaptive = adaptive
+        self.tokens = self.burst if full else 0
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until a session can be started"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # Take the token right away, even if it's not there yet. Tokens can go negative, so
+        # sessions that wait at the same time start one after the other in order.
+        self.tokens -= 1
+        if self.tokens < 0:
+            await sleep(-self.tokens / self.rate)
+
+    def update(self, throttled):
+        """Adapt the rate based on whether a connection was throttled"""
+        if throttled:
+            self.rate = max(self.rate / 2, self.max_rate * ADAPTIVE_MIN_RATE)
+        else:
+            self.rate = min(self.rate + self.max_rate / 10, self.max_rate)
+
+
+def get_rate_key(group):
+    """Returns the options of a group that determine its rate limiter"""
+    return tuple(group.get(k) for k in ("rate", "burst", "adaptive", "sleep"))
+
+
+def create_rate_limiter(group):
+    """Returns a RateLimiter for the rate options of a group, or None if its rate isn't limited"""
+    if group.get("rate") or group.get("adaptive"):
+        return RateLimiter(
+            group.get("rate") or DEFAULT_RATE,
+            group.get("burst") or 1,
+            adaptive=group.get("adaptive"),
+        )
+
+    # Sleeping s seconds before every session is the same as starting a session every s
+    # seconds, including the first one.
+    if s := group.get("sleep"):
+        return RateLimiter(1 / s, 1, full=False)
+
+    return None
+
+
+async def watch_for_throttling(pane, timeout):
+    """
+    Watch the screen of a pane for timeout seconds after starting ssh and return whether the
+    connection failed in a way that suggests that the server is throttling connections.
+    """
+
+    async def throttled():
+        # Start streaming before getting the current contents, so no update is missed.
+        # Only output from the line the cursor is on now is taken into account, since
+        # errors from an earlier attempt may still be on the screen.
+        async with pane.get_screen_streamer() as streamer:
+            contents = await pane.async_get_screen_contents()
+            first_line = contents.cursor_coord.y
+            while not shows_throttling(contents, first_line):
+                contents = await streamer.async_get()
+
+    try:
+        await asyncio.wait_for(throttled(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def shows_throttling(contents, first_line):
+    """
+    Returns whether the screen contents show one of THROTTLING_ERRORS on or after first_line,
+    which is a line number that includes the lines above the screen.
+    """
+    if contents is None:
+        return False
+
+    start = max(first_line - contents.number_of_lines_above_screen, 0)
+    for i in range(start, contents.number_of_lines):
+        line = contents.line(i).string
+        if any(error in line for error in THROTTLING_ERRORS):
+            return True
+    return False
+
+
+class LaunchStats:
+    """
+    Keeps track of the time a launch takes and the requests it makes to iTerm2.
+
+    The iTerm2 API doesn't have a way to batch requests, but requests that are made
+    concurrently are pipelined over the same connection. A round trip is therefore only
+    counted when a request is made while no other request is in flight.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.round_trips = 0
+        self.in_flight = 0
+        self.saved = None
+
+    def track(self, connection):
+        """Count all requests that are made over the given connection"""
+        dispatch_until_id = connection.async_dispatch_until_id
+
+        async def tracked_dispatch_until_id(reqid):
+            if self.in_flight == 0:
+                self.round_trips += 1
+            self.requests += 1
+            self.in_flight += 1
+            try:
+                return await dispatch_until_id(reqid)
+            finally:
+                self.in_flight -= 1
+
+        connection.async_dispatch_until_id = tracked_dispatch_until_id
+
+    def report(self, panes):
+        """Returns a human readable summary of the launch"""
+        elapsed = time.monotonic() - self.started
+        report = (
+            f"Launched {panes} panes in {elapsed:.2f}s using {self.requests} iTerm2 requests "
+            f"in {self.round_trips} round trips"
+        )
+        if self.saved is not None:
+            report += (
+                f"\nPlanning alongside the iTerm2 handshake saved {self.saved:.2f}s"
+            )
+        return report
+
+
+async def build_group(
+    group,
+    session,
+    lwops,
+    limiter=None,
+    on_layout=None,
+    on_started=None,
+    masters=None,
+    semaphore=None,
+):
+    """
+    Split the first session of a group's tab into the group's grid and start the sessions for
+    all hosts of the group, limiting their rate with limiter and their concurrency with
+    semaphore if given. Returns the panes of the group.
+
+    on_layout is awaited with the panes once they're split, and on_started is called with
+    every pane that has started its session. If the hosts are a HostStream, sessions start as
+    the hosts are read and panes that are left when the stream ends are closed. masters are the
+    ControlMaster connections that are being opened (see open_control_masters).
+    """
+    # In direct mode, panes start their session as soon as they're split
+    if group.get("direct") and masters:
+        await asyncio.gather(*[wait_for_master(masters, h) for h in group["hosts"]])
+
+    counts = get_row_counts(group)
+    hosts = len(group["hosts"])
+    vertical = group.get("direction", "") != "row"
+
+    # Split the first pane into all panes of the group; independent parts of the layout are
+    # split concurrently. A full grid is split into columns first, while a grid where the
+    # last row has fewer panes is split into rows first.
+    if len(set(counts)) == 1:
+        panes = await split_grid(
+            group.get("profile"), lwops, session, counts[0], len(counts), vertical
+        )
+    else:
+        panes = await split_rows(group.get("profile"), lwops, session, counts, vertical)
+
+    if on_layout:
+        await on_layout(panes)
+
+    # In direct mode the panes with hosts are already running their command
+    if group.get("direct"):
+        if on_started:
+            for pane in panes[: len(group["hosts"])]:
+                on_started(pane)
+    else:
+        await start_sessions(
+            panes,
+            group["hosts"],
+            group.get("concurrency"),
+            group.get("prompt_timeout"),
+            limiter,
+            on_started,
+            masters,
+            semaphore,
+        )
+
+    # Now that the stream has ended, the number of hosts is known
+    if isinstance(group["hosts"], HostStream):
+        read = len(group["hosts"])
+        await asyncio.gather(*[close_pane(pane) for pane in panes[read:hosts]])
+        panes = panes[:read] + panes[hosts:]
+
+    return panes
+
+
+async def start_sessions(
+    panes,
+    hosts,
+    concurrency,
+    prompt_timeout=None,
+    limiter=None,
+    on_started=None,
+    masters=None,
+    semaphore=None,
+):
+    """
+    Start the sessions for all hosts in their panes. Panes are handled concurrently, but at most
+    concurrency panes at a time, in the order of the hosts. Commands within a single pane are
+    still sent in order. Tabs that share a semaphore share their concurrency, in which case
+    concurrency is ignored.
+
+    If prompt_timeout is set, commands are only sent to a pane once its shell shows a prompt,
+    or after prompt_timeout seconds. If a RateLimiter is given, sessions are started at the
+    rate it allows. on_started is called with every pane once its session has started. If
+    the ControlMaster connection of a host is still being opened, its session waits for it.
+
+    hosts can also be a HostStream, in which case the session of a host is started as soon as
+    it's read.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(concurrency or DEFAULT_CONCURRENCY, 1))
+
+    async def start(p, pane):
+        # Waiting for the prompt or the rate limiter doesn't count towards the concurrency,
+        # so panes that are ready don't have to wait for panes that aren't.
+        if prompt_timeout:
+            await wait_for_prompt(pane, prompt_timeout)
+        if masters:
+            await wait_for_master(masters, hosts[p])
+
+        for attempt in range(ADAPTIVE_RETRIES + 1):
+            if limiter:
+                await limiter.acquire()
+
+            async with semaphore:
+                await start_session(pane, p, hosts[p])
+
+            # In adaptive mode, watch whether the connection is throttled. If it is, the
+            # limiter slows down and the session is started again, unless the pane is gone
+            # because ssh was started with exec.
+            if not (limiter and limiter.adaptive):
+                break
+            throttled = await watch_for_throttling(pane, ADAPTIVE_WATCH_TIME)
+            limiter.update(throttled)
+            if not throttled or hosts[p].get("exec"):
+                break
+
+        if on_started:
+            on_started(pane)
+
+    if isinstance(hosts, HostStream):
+        started = [
+            asyncio.ensure_future(start(p, panes[p])) async for p in hosts.arrive()
+        ]
+        await asyncio.gather(*started)
+        return
+
+    # There might be more panes than hosts. The remaining panes are UNUSED panes, which
+    # already show that when they're created.
+    await asyncio.gather(
+        *[start(p, pane) for p, pane in enumerate(panes[: len(hosts)])]
+    )
+
+
+async def start_session(pane, p, host_opts):
+    """Start the session for a host in a pane. p is the index of the host in its group"""
+    host = get_host_str(host_opts)
+
+    # If a custom command is specified, execute that and don't care about ssh at all
+    custom_command = host_opts.get("custom_command")
+    if custom_command:
+        cmd = get_custom_command(custom_command, host)
+        await execute_command(pane, f" unset HISTFILE && {cmd}\n")
+    else:
+        env_vars = get_env_vars(p, host_opts)
+        send_env = ""
+
+        # If we have env vars, we export them and set them in the
+        # ssh options. The export is sent together with the ssh command, so
+        # starting a session only takes a single request.
+        env_vars_cmd = ""
+        if len(env_vars) > 0:
+            (env_vars_str, send_env) = get_env_vars_str(env_vars)
+            env_vars_cmd = f"{env_vars_str}\n"
+
+        ssh_prefix = create_ssh_prefix(
+            host_opts.get("forward_agent"),
+            host_opts.get("extra"),
+            host_opts.get("gateway"),
+            get_control_path(host_opts),
+            get_gateway_control_path(host_opts),
+        )
+
+        if host_opts.get("exec"):
+            # Set ControlMaster=no as a workaround for
+            # https://gitlab.com/gnachman/iterm2/-/issues/11032
+            ssh_prefix = f"exec {ssh_prefix} -o ControlMaster=no"
+
+        cmd = f"unset HISTFILE && {ssh_prefix} {send_env} {host}\n"
+        cmd = re.sub(" +", " ", cmd)
+        await execute_command(pane, env_vars_cmd + cmd)
+
+
+def get_direct_command(p, host_opts):
+    """
+    Returns the command that starts the session for a host without a shell. This command is
+    used as the command of the pane, so the pane starts straight into ssh (or the custom
+    command) and closes when it exits. p is the index of the host in its group
+    """
+    host = get_host_str(host_opts)
+
+    if custom_command := host_opts.get("custom_command"):
+        return get_custom_command(custom_command, host)
+
+    env_vars = get_env_vars(p, host_opts)
+    ssh_prefix = create_ssh_prefix(
+        host_opts.get("forward_agent"),
+        host_opts.get("extra"),
+        host_opts.get("gateway"),
+        get_control_path(host_opts),
+        get_gateway_control_path(host_opts),
+    )
+
+    # The pane closes when ssh exits, just like with exec, so the same workaround for
+    # https://gitlab.com/gnachman/iterm2/-/issues/11032 is needed.
+    cmd = f"{ssh_prefix} -o ControlMaster=no"
+
+    # There is no shell to export env vars in, so we set them through env
+    if len(env_vars) > 0:
+        env = " ".join([f"{k}={v}" for k, v in env_vars.items()])
+        _, send_env = get_env_vars_str(env_vars)
+        cmd = f"/usr/bin/env {env} {cmd} {send_env}"
+
+    return re.sub(" +", " ", f"{cmd} {host}")
+
+
+def get_custom_command(custom_command, host):
+    """Returns the custom command for a host"""
+    # substitute the host name in the custom command
+    return custom_command.replace("{host}", host).lstrip()
+
+
+def get_env_vars(p, host_opts):
+    """Returns a dict with the environment variables to send for a host"""
+    env_vars = {}
+
+    # Rank is just an env var, so set it if we have it
+    if host_opts.get("rank"):
+        env_vars["LC_RANK"] = str(p)
+
+    # Split other env vars by comma and put them in a dict
+    if from_env := host_opts.get("environment"):
+        # if from_env is a dict, assign
+        if isinstance(from_env, dict):
+            env_vars = from_env
+        else:
+            env_vars.update(dict(s.split("=") for s in from_env.split(",")))
+
+    return env_vars
+
+
+async def split_grid(profile_name, lwops, pane, cols, rows, vertical):
+    """
+    Split a pane into a grid of cols x rows panes and return the panes in row-major order.
+    lwops holds the profile customizations for every pane of the grid, also in row-major
+    order. The pane that's split should already have the customizations of the first pane.
+
+    The pane is first split into columns, after which every column is split into rows. Both
+    steps bisect (see bisect_pane), so the grid is built in O(log(cols) + log(rows)) dependent
+    round trips to iTerm2 instead of one round trip per pane.
+    """
+    columns = await bisect_pane(
+        profile_name,
+        [lwops[col_row_to_index(col, 0, cols)] for col in range(cols)],
+        vertical,
+        pane,
+    )
+    stacks = await asyncio.gather(
+        *[
+            bisect_pane(
+                profile_name,
+                [lwops[col_row_to_index(col, row, cols)] for row in range(rows)],
+                not vertical,
+                column,
+            )
+            for col, column in enumerate(columns)
+        ]
+    )
+
+    panes = [None] * (cols * rows)
+    for col, stack in enumerate(stacks):
+        for row, pane in enumerate(stack):
+            panes[col_row_to_index(col, row, cols)] = pane
+    return panes
+
+
+async def split_rows(profile_name, lwops, pane, counts, vertical):
+    """
+    Split a pane into len(counts) rows, where each row has counts[row] panes, and return the
+    panes in row-major order. Like split_grid, lwops holds the customizations for every pane.
+    """
+    starts = [sum(counts[:row]) for row in range(len(counts))]
+    rows = await bisect_pane(
+        profile_name, [lwops[start] for start in starts], not vertical, pane
+    )
+    row_panes = await asyncio.gather(
+        *[
+            bisect_pane(profile_name, lwops[start : start + count], vertical, row)
+            for start, count, row in zip(starts, counts, rows)
+        ]
+    )
+    return flatten(row_panes)
+
+
+async def bisect_pane(profile_name, lwops, vertical, pane):
+    """
+    Split a pane into len(lwops) panes side by side (or stacked if vertical is False) and
+    return them in order. After the first split, both halves are split further concurrently.
+    """
+    if len(lwops) <= 1:
+        return [pane]
+
+    # The new pane is placed right of (or below) the pane that's split, so it becomes the
+    # first pane of the second half.
+    half = math.ceil(len(lwops) / 2)
+    new_pane = await split_pane(profile_name, lwops[half], vertical, pane)
+    first, second = await asyncio.gather(
+        bisect_pane(profile_name, lwops[:half], vertical, pane),
+        bisect_pane(profile_name, lwops[half:], vertical, new_pane),
+    )
+    return first + second
+
+
 async def split_pane(profile_name, lwop, vertical, pane):
     """Split a pane vertically or horizontally, depending on the vertical parameter"""
     pane = await pane.async_split_pane(
@@ -463,12 +1354,29 @@ async def split_pane(profile_name, lwop, vertical, pane):
 
 def create_lwop(shell):
     """Create a LocalWriteOnlyProfile that sets the shell to be used for the session"""
+    from iterm2.profile import LocalWriteOnlyProfile
+
     lwop = LocalWriteOnlyProfile()
     lwop.set_use_custom_command("Yes")
     lwop.set_command(f"{shell}\n")
     return lwop
 
 
+def create_unused_lwop():
+    """
+    Create a LocalWriteOnlyProfile for an UNUSED pane. Rather than starting a shell, the pane
+    runs a command that shows UNUSED in red at the bottom of the pane and ignores all input.
+    """
+    from iterm2.color import Color
+
+    lwop = create_lwop(
+        '/bin/sh -c "stty -isig -icanon -echo; for i in $(seq 100); do echo; done; '
+        'echo UNUSED; exec cat > /dev/null"'
+    )
+    lwop.set_foreground_color(Color.from_hex("#ff0000"))
+    return lwop
+
+
 async def sleep(s):
     """Sleep for s seconds"""
     await asyncio.sleep(s)
@@ -481,6 +1389,8 @@ async def set_fullscreen(window):
 
 async def get_window(connection):
     """Get the current window"""
+    import iterm2
+
     # Setup iterm API connection
     app = await iterm2.async_get_app(connection)
     window = app.current_window
@@ -488,6 +1398,11 @@ async def get_window(connection):
     return window
 
 
+async def close_pane(pane):
+    """Close a pane without asking for confirmation"""
+    await pane.async_close(force=True)
+
+
 async def create_window(connection, window, profile_name, lwop):
     """Create a new window"""
     return await window.async_create(
@@ -497,35 +1412,128 @@ async def create_window(connection, window, profile_name, lwop):
 
 async def create_tab(window, profile_name, lwop):
     """Create a new tab in the given window"""
-    await window.async_create_tab(profile_name, profile_customizations=lwop)
+    return await window.async_create_tab(profile_name, profile_customizations=lwop)
 
 
 async def execute_command(pane, cmd):
-    """Executes a command in a pane"""
-    await pane.async_send_text(cmd)
-
-
-async def create_unused_pane(pane):
-    """Creates an UNUSED pane"""
-    profile = await pane.async_get_profile()
-    await pane.async_send_text(f"unset HISTFILE\n")
-    await asyncio.sleep(0.3)
-    await profile.async_set_foreground_color(Color.from_hex("#ff0000"))
-    crs = "\n" * 100
-    await pane.async_send_text(
-        f"stty -isig -icanon -echo && echo -e '{crs}UNUSED' && cat > /dev/null\n"
-    )
+    """
+    Executes a command in a pane. The command is never broadcast, since other panes might have
+    joined a broadcast domain already.
+    """
+    await pane.async_send_text(cmd, suppress_broadcast=True)
+
+
+async def wait_for_prompt(pane, timeout):
+    """
+    Wait until the shell in a pane shows its prompt, or until timeout seconds have passed.
+    Returns whether the prompt was found.
+    """
+
+    async def prompt_shown():
+        # Start streaming before getting the current contents, so no update is missed
+        async with pane.get_screen_streamer() as streamer:
+            contents = await pane.async_get_screen_contents()
+            while not has_prompt(contents):
+                contents = await streamer.async_get()
+
+    try:
+        await asyncio.wait_for(prompt_shown(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def has_prompt(contents):
+    """
+    Returns whether the screen contents show a prompt. A shell that's waiting for input has
+    drawn its prompt on the line the cursor is on, while any output before that (like the
+    "Last login" message) ends with a newline, leaving the cursor on an empty line.
+    """
+    if contents is None:
+        return False
+
+    cursor = contents.cursor_coord
+    index = cursor.y - contents.number_of_lines_above_screen
+    if not 0 <= index < contents.number_of_lines:
+        return False
+
+    return contents.line(index).string[: cursor.x].strip() != ""
 
 
 def get_host_strs_from_file(filename):
-    """Gets a list of host strings from a file"""
+    """Gets a list of host strings from a file, or from stdin if filename is -"""
+    from i2cssh.inventory import parse_host_line
+
     hosts = []
-    with open(filename) as f:
+    with click.open_file(filename) as f:
         for line in f:
-            hosts.append(line.strip())
+            if host_str := parse_host_line(line):
+                hosts.append(host_str)
     return hosts
 
 
+class HostStream:
+    """
+    Hosts that are read from a file or pipe while the launch is already going on, so sessions
+    can start before the whole file has been read. Hosts that are known up front can be put in
+    hosts and come first. f is a file opened with click.open_file, so stdin is never closed.
+
+    At most max_hosts hosts are read. Until the stream ends, its length is the number of panes
+    it needs: the hosts known so far plus the hosts that can still be read. After that, it's
+    the number of hosts. Hosts that are read get the options of the template.
+    """
+
+    def __init__(self, f, max_hosts, cluster_index=None):
+        self.f = f
+        self.remaining = max_hosts
+        self.cluster_index = cluster_index
+        self.hosts = []
+        self.template = Host(None)
+        self.done = False
+
+    def __len__(self):
+        return len(self.hosts) + (0 if self.done else self.remaining)
+
+    def __getitem__(self, p):
+        return self.hosts[p]
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    async def arrive(self):
+        """Yields the index of every host as soon as it's known"""
+        loop = asyncio.get_running_loop()
+        p = 0
+        while True:
+            while p < len(self.hosts):
+                yield p
+                p += 1
+            if self.done:
+                return
+            # Reading blocks until the next line is written, so it's done in a thread
+            await loop.run_in_executor(None, self.read)
+
+    def read(self):
+        """Read the hosts on the next line with hosts, or mark the stream as done at its end"""
+        from i2cssh.inventory import parse_host_line
+
+        while self.remaining > 0:
+            host_str = self.f.readline()
+            if not host_str:
+                break
+            if host_str := parse_host_line(host_str):
+                hosts = get_hosts([host_str], self.cluster_index, self.remaining)
+                for host in hosts:
+                    host.options = self.template.options
+                self.hosts += hosts
+                self.remaining -= len(hosts)
+                return
+
+        # Leaving the context of the file closes it, unless it's stdin
+        with self.f:
+            self.done = True
+
+
 def sanitize_options(opts):
     """
     Sanitize options, since we need to be able to distinguish between
@@ -539,6 +1547,8 @@ def sanitize_options(opts):
 
 
 async def enable_broadcast(connection, broadcast_domains):
+    import iterm2
+
     domains = []
     for panes in broadcast_domains:
         domain = iterm2.broadcast.BroadcastDomain()
@@ -550,6 +1560,8 @@ async def enable_broadcast(connection, broadcast_domains):
 
 
 async def set_broadcast_domains(connection, domains):
+    import iterm2
+
     await iterm2.async_set_broadcast_domains(connection, domains)
 
 
@@ -568,8 +1580,14 @@ def get_env_vars_str(env_vars):
     return (env_vars_str, send_env)
 
 
-def create_ssh_prefix(forward_agent, extra, gateway):
-    """Returns a string that contains the ssh prefix, including the ssh options"""
+def create_ssh_prefix(
+    forward_agent, extra, gateway, control_path=None, gateway_control_path=None
+):
+    """
+    Returns a string that contains the ssh prefix, including the ssh options. If control_path
+    is set, ssh reuses the ControlMaster connection at that path if there is one. The same goes
+    for the connection to the gateway and gateway_control_path.
+    """
     ssh_options = []
     if forward_agent:
         ssh_options.append("-A")
@@ -587,11 +1605,203 @@ def create_ssh_prefix(forward_agent, extra, gateway):
                     ssh_options.append(f"-{e}")
 
     if gateway:
-        ssh_options.append(f'-o ProxyCommand="ssh -W %h:%p {gateway}"')
+        proxy_command = get_proxy_command(gateway, gateway_control_path)
+        ssh_options.append(f'-o ProxyCommand="{proxy_command}"')
+
+    if control_path:
+        ssh_options.append(f'-o ControlPath="{control_path}"')
 
     return "ssh " + " ".join(ssh_options)
 
 
+def get_proxy_command(gateway, control_path=None):
+    """
+    Returns the command that connects to a host through a gateway. A gateway can also be a chain
+    of comma-separated hops, in which case the last hop is reached through the others.
+    """
+    *hops, last = split_gateway(gateway)
+    ssh_options = []
+    if control_path:
+        # ssh expands the tokens in ProxyCommand itself, so the ones for the ssh that's started
+        # by the ProxyCommand have to be escaped. The ProxyCommand is itself in double quotes,
+        # so the path is in single quotes.
+        ssh_options.append(f"-o ControlPath='{control_path.replace('%', '%%')}'")
+    if hops:
+        ssh_options.append(f"-J {','.join(hops)}")
+    return " ".join(["ssh", *ssh_options, "-W %h:%p", last])
+
+
+def split_gateway(gateway):
+    """Returns the hops of a gateway, which can be a chain of comma-separated hops"""
+    return [hop.strip() for hop in gateway.split(",") if hop.strip()]
+
+
+def get_gateway_control_path(host_opts):
+    """
+    Returns the ControlPath of the multiplexed connection to the gateway of a host, or None if
+    the host doesn't have a gateway or doesn't use gateway_mux. Like with get_control_path, %C
+    makes every gateway get its own connection.
+    """
+    if host_opts.get("gateway") and host_opts.get("gateway_mux"):
+        return os.path.join(get_cache_dir(), "cm-%C")
+    return None
+
+
+def get_gateway_master_command(host_opts):
+    """
+    Returns the ssh command that opens the multiplexed connection to the gateway of a host. For a
+    chain of hops, the connection goes to the last hop, through the others.
+    """
+    *hops, last = split_gateway(host_opts["gateway"])
+    jump = f"-J {','.join(hops)}" if hops else ""
+    cmd = (
+        f'ssh -o ControlPath="{get_gateway_control_path(host_opts)}" {jump} '
+        f"{MASTER_OPTIONS} {last}"
+    )
+    return re.sub(" +", " ", cmd)
+
+
+def get_control_path(host_opts):
+    """
+    Returns the ControlPath of the ControlMaster connection for a host, or None if the host
+    doesn't use prewarm. ssh replaces %C by a hash of the host, port and login, which keeps the
+    path short enough for a socket.
+    """
+    if host_opts.get("prewarm") and not host_opts.get("custom_command"):
+        return os.path.join(get_cache_dir(), "cm-%C")
+    return None
+
+
+def get_master_command(host_opts):
+    """
+    Returns the ssh command that opens the ControlMaster connection for a host. ssh goes to the
+    background once the connection is set up and keeps it open for CONTROL_PERSIST seconds
+    after the last session that uses it has closed. BatchMode makes it fail rather than ask for
+    a password that nobody can type.
+    """
+    # Forwards and ttys are for the sessions. The master would otherwise bind the forwarded
+    # ports itself, so the sessions can't.
+    ssh_prefix = create_ssh_prefix(
+        False,
+        get_master_extra(host_opts.get("extra")),
+        host_opts.get("gateway"),
+        get_control_path(host_opts),
+        get_gateway_control_path(host_opts),
+    )
+    cmd = f"{ssh_prefix} {MASTER_OPTIONS} {get_host_str(host_opts)}"
+    return re.sub(" +", " ", cmd)
+
+
+def get_master_extra(extra):
+    """Returns the extra ssh options without the ones for forwards and ttys"""
+    if not extra:
+        return extra
+
+    def keep(k, v):
+        if k == "o":
+            return re.split(r"[\s=]", str(v), 1)[0].lower() not in MASTER_SKIPPED_CONFIG
+        return k not in MASTER_SKIPPED_OPTIONS
+
+    if isinstance(extra, dict):
+        return {k: v for k, v in extra.items() if keep(k, v)}
+    return [e for e in extra if keep(*e.partition("=")[::2])]
+
+
+def open_control_masters(hosts, concurrency, timeout=PREWARM_TIMEOUT):
+    """
+    Start opening the ControlMaster connections for all hosts that use prewarm in the
+    background, at most concurrency at a time. Sessions in panes then reuse these connections
+    and skip the ssh handshake. Reusing a connection works with ControlMaster=no, so this also
+    works with exec and direct mode.
+
+    For hosts that use gateway_mux, a single connection to every distinct gateway is opened
+    before the connections to the hosts behind it. All sessions and connections to hosts behind
+    that gateway go through it, so the gateway only sees a single authentication.
+
+    Returns a dict from the command of every connection to a task that's done once the
+    connection is up, or has been given up on because it wasn't up within timeout seconds.
+    The sessions for those hosts make their own connection, just like without prewarm or
+    gateway_mux.
+    """
+    import subprocess
+
+    gateways = {
+        get_master_command(host): get_gateway_master_command(host)
+        for host in hosts
+        if get_control_path(host) and get_gateway_control_path(host)
+    }
+    commands = dict.fromkeys(
+        [
+            get_gateway_master_command(host)
+            for host in hosts
+            if get_gateway_control_path(host)
+        ]
+        + [get_master_command(host) for host in hosts if get_control_path(host)]
+    )
+    if not commands:
+        return {}
+
+    os.makedirs(get_cache_dir(), exist_ok=True)
+    semaphore = asyncio.Semaphore(max(concurrency or DEFAULT_CONCURRENCY, 1))
+    deadline = time.monotonic() + timeout
+    masters = {}
+
+    async def open_master(command):
+        # A connection through a gateway can only be opened once the gateway's is up
+        if gateway := gateways.get(command):
+            await masters[gateway]
+        async with semaphore:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                await asyncio.wait_for(
+                    process.wait(), max(deadline - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    for command in commands:
+        masters[command] = asyncio.ensure_future(open_master(command))
+    return masters
+
+
+async def wait_for_master(masters, host_opts):
+    """Wait for the ControlMaster connection that the session of a host reuses, if any"""
+    if get_control_path(host_opts):
+        master = masters.get(get_master_command(host_opts))
+    elif get_gateway_control_path(host_opts):
+        master = masters.get(get_gateway_master_command(host_opts))
+    else:
+        return
+    if master:
+        await master
+
+
+def get_row_counts(group):
+    """
+    Returns the number of panes in every row of a group. Unless the group should fill up the
+    grid with UNUSED panes, the last row only has as many panes as there are hosts left, so
+    those panes become wider. If the number of rows was set, the hosts are spread over all of
+    these rows instead, so the first rows get one pane more than the others.
+    """
+    cols = group["geometry"]["cols"]
+    rows = group["geometry"]["rows"]
+    if group.get("fill_unused"):
+        return [cols] * rows
+
+    hosts = len(group["hosts"])
+    if group.get("rows") and hosts:
+        rows = min(rows, hosts)
+        per_row, extra = divmod(hosts, rows)
+        return [per_row + 1] * extra + [per_row] * (rows - extra)
+    return [min(cols, hosts - row * cols) for row in range(rows) if row * cols < hosts]
+
+
 def col_row_to_index(col, row, cols):
     """Calcualate the index of a pane based on row and column"""
     return row * cols + col
@@ -614,13 +1824,262 @@ def compute_geometry(hosts, rows, cols):
     return {"rows": rows, "cols": cols, "requires_fullscreen": rows >= 12 or cols >= 16}
 
 
-def get_hosts(host_strings):
-    """Get hosts from a list of hostname or login@hostname strings"""
-    hosts = host_strings_to_hosts(host_strings)
+def get_hosts(host_strings, cluster_index=None, limit=None):
+    """
+    Get hosts from a list of hostname or login@hostname strings. A hostname can also be a glob
+    or /regex/ pattern, which selects all matching hosts of the clusters in cluster_index.
+    If limit is set, only the first limit hosts are returned, and only those are expanded.
+    """
+    host_strings = expand_host_strings(host_strings, limit)
+    if cluster_index is not None:
+        host_strings = itertools.chain.from_iterable(
+            expand_host_pattern(host_string, cluster_index)
+            for host_string in host_strings
+        )
+    hosts = host_strings_to_hosts(itertools.islice(host_strings, limit))
     return hosts
 
 
-def get_clusters_from_cluster_names(cluster_names, config, valid_options):
+def expand_host_strings(host_strings, limit=None, check_size=True):
+    """Lazily expands the ranges and braces in all host strings (see HostExpansion)"""
+    for host_string in host_strings:
+        yield from expand_host_string(host_string, limit, check_size)
+
+
+def expand_host_string(host_string, limit=None, check_size=True):
+    """
+    Returns an iterator over the host strings a host string expands to. If check_size is set,
+    a host string that expands to more than MAX_EXPANSION host strings is rejected before any
+    of them are generated, unless only the first limit of them are used. Hosts from the config
+    aren't checked, so a big cluster doesn't get in the way of the ones that are used.
+    """
+    # Regexes are left alone, since they use braces and brackets themselves
+    if is_regex(host_string):
+        return iter([host_string])
+
+    expansion = HostExpansion(host_string)
+    if not check_size:
+        return iter(expansion)
+    size = len(expansion)
+    if size > MAX_EXPANSION and not (limit and limit <= MAX_EXPANSION):
+        click.echo(
+            f"{host_string} expands to {size} hosts, "
+            f"which is more than the maximum of {MAX_EXPANSION}"
+        )
+        sys.exit(EXIT_CODE_TOO_MANY_HOSTS)
+    return iter(expansion)
+
+
+class HostExpansion:
+    """
+    The host strings that a host string with ranges and braces expands to. A range like
+    web[001-500] expands to web001 up to web500, keeping the leading zeros, and [1-9:2] only
+    takes every second number. Braces like {a,b}-db expand to a-db and b-db. Since host strings
+    are generated lazily, an expansion can be counted with len() or sliced with islice without
+    generating all host strings.
+    """
+
+    EXPANSION = re.compile(r"\[(\d+)-(\d+)(?::([1-9]\d*))?\]|\{([^{}]*,[^{}]*)\}")
+
+    def __init__(self, host_string):
+        self.segments = []
+        pos = 0
+        for match in self.EXPANSION.finditer(host_string):
+            start, end, step, alternatives = match.groups()
+            self.segments.append((host_string[pos : match.start()],))
+            if alternatives is None:
+                self.segments.append(HostRange(start, end, int(step or 1)))
+            else:
+                self.segments.append(
+                    HostAlternatives(
+                        [HostExpansion(a) for a in alternatives.split(",")]
+                    )
+                )
+            pos = match.end()
+        self.segments.append((host_string[pos:],))
+
+    def __len__(self):
+        return math.prod(len(segment) for segment in self.segments)
+
+    def __iter__(self):
+        return expand_segments(self.segments)
+
+
+def expand_segments(segments):
+    """Yields every combination of the strings of the segments, keeping the order"""
+    if not segments:
+        yield ""
+        return
+    for head in segments[0]:
+        for tail in expand_segments(segments[1:]):
+            yield head + tail
+
+
+class HostRange:
+    """The numbers of a range in a host string, see HostExpansion"""
+
+    def __init__(self, start, end, step):
+        # Ranges like [001-500] keep the width of their start
+        self.width = len(start) if start.startswith("0") else 0
+        if int(start) <= int(end):
+            self.numbers = range(int(start), int(end) + 1, step)
+        else:
+            self.numbers = range(int(start), int(end) - 1, -step)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        return (f"{number:0{self.width}d}" for number in self.numbers)
+
+
+class HostAlternatives:
+    """The alternatives between braces in a host string, see HostExpansion"""
+
+    def __init__(self, expansions):
+        self.expansions = expansions
+
+    def __len__(self):
+        return sum(len(expansion) for expansion in self.expansions)
+
+    def __iter__(self):
+        for expansion in self.expansions:
+            yield from expansion
+
+
+def expand_host_pattern(host_string, cluster_index):
+    """
+    Returns the host strings of all known hosts that match a [login@]pattern, or just the host
+    string itself if it isn't a pattern. A login in the pattern overrides the login of the
+    matching hosts.
+    """
+    (login, hostname) = parse_hostname(host_string)
+    if not is_pattern(hostname):
+        return [host_string]
+
+    host_strings = cluster_index.match_hosts(hostname)
+    if not host_strings:
+        click.echo(f"No hosts match {hostname}")
+        sys.exit(EXIT_CODE_NO_HOSTS)
+
+    if login:
+        host_strings = [f"{login}@{parse_hostname(h)[1]}" for h in host_strings]
+    return host_strings
+
+
+def is_pattern(name):
+    """Returns whether a name is a /regex/ or a glob pattern rather than a plain name"""
+    # Brackets of ranges like [1-10] are expanded rather than matched
+    name_without_ranges = HostExpansion.EXPANSION.sub("", name)
+    return is_regex(name) or any(c in name_without_ranges for c in "*?[")
+
+
+def is_regex(name):
+    return len(name) > 1 and name.startswith("/") and name.endswith("/")
+
+
+def split_list(value):
+    """
+    Split a comma separated list. Commas inside /regex/ items or braces like {a,b} don't split
+    the list.
+    """
+    items = [""]
+    in_regex = False
+    braces = 0
+    for c in value:
+        if c == "," and not in_regex and braces == 0:
+            items.append("")
+            continue
+        if c == "/" and (in_regex or not items[-1]) and not items[-1].endswith("\\"):
+            in_regex = not in_regex
+        elif c in "{}" and not in_regex:
+            braces = max(braces + (1 if c == "{" else -1), 0)
+        items[-1] += c
+    return items
+
+
+class NameIndex:
+    """
+    Sorted index of names that finds the names matching a glob or /regex/ pattern. Only the
+    names that start with the literal prefix of the pattern are matched against it, which are
+    found by bisecting the sorted names.
+    """
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+
+    def add(self, names):
+        """Add names that aren't in the index yet"""
+        # Both lists are sorted, which makes sorting them together about linear
+        self.names = sorted(self.names + sorted(names))
+
+    def match(self, pattern):
+        """Returns the names that match a pattern, in sorted order"""
+        import fnmatch
+
+        try:
+            if is_regex(pattern):
+                matches = re.compile(pattern[1:-1]).search
+            else:
+                matches = re.compile(fnmatch.translate(pattern)).match
+        except re.error as exc:
+            click.echo(f"Invalid pattern {pattern}: {exc}")
+            sys.exit(EXIT_CODE_INVALID_PATTERN)
+        return [name for name in self.candidates(pattern) if matches(name)]
+
+    def candidates(self, pattern):
+        """Returns the names that start with the literal prefix of a pattern"""
+        from bisect import bisect_left
+
+        prefix = get_literal_prefix(pattern)
+        start = bisect_left(self.names, prefix)
+        # Every name that starts with the prefix sorts before prefix + the highest character
+        end = bisect_left(self.names, prefix + "\U0010ffff", start) if prefix else None
+        return self.names[start:end]
+
+
+def get_literal_prefix(pattern):
+    """
+    Returns the literal text every name matching a glob or /regex/ pattern starts with. A regex
+    only has a literal prefix if it's anchored with ^ and has no alternatives outside groups.
+    """
+    if is_regex(pattern):
+        regex = pattern[1:-1]
+        if not regex.startswith("^") or has_top_level_alternative(regex):
+            return ""
+        special, quantifiers = ".^$*+?{}[]\\|()", "*+?{"
+        prefix = ""
+        for i, c in enumerate(regex[1:], 1):
+            if c in special:
+                # The last literal character is optional if it's followed by a quantifier
+                if c in quantifiers:
+                    prefix = prefix[:-1]
+                break
+            prefix += c
+        return prefix
+
+    return re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+
+
+def has_top_level_alternative(regex):
+    """Returns whether a regex contains a | that isn't inside a group"""
+    depth = 0
+    escaped = False
+    for c in regex:
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+    return False
+
+
+def get_clusters_from_cluster_names(cluster_names, cluster_index, valid_options):
     """
     Get hosts from a list of cluster names. Note that this returns
     a list of lists of hosts; one list per cluster.
@@ -630,54 +2089,519 @@ def get_clusters_from_cluster_names(cluster_names, config, valid_options):
     """
     clusters = []
 
+    # The inventory commands of all clusters run at the same time
+    cluster_names = cluster_index.expand_cluster_names(cluster_names)
+    cluster_index.prefetch(cluster_names)
+
     for cluster_name in cluster_names:
-        if not config.get("clusters"):
-            click.echo("No clusters found in config file")
-            sys.exit(EXIT_CODE_NO_CLUSTERS)
 
-        if cluster_name not in config["clusters"]:
+        # Note that the cluster options from included clusters are ignored.
+        host_strings = cluster_index.get_host_strings(cluster_name)
+        cluster_options = filter_valid_options(
+            cluster_index.clusters[cluster_name], valid_options
+        )
+        clusters.append(host_strings_to_hosts(host_strings, cluster_options))
+    return clusters
+
+
+class ClusterIndex:
+    """
+    Resolves the hosts of the clusters in a config. Clusters can include the hosts of other
+    clusters through include_from, which in turn can include other clusters. Every cluster is
+    only resolved once, no matter how many clusters include it.
+
+    Clusters can also get their hosts from an inventory command or kubernetes (see
+    i2cssh.inventory). The hosts of these inventories are fetched at once with prefetch.
+
+    The indexes of the names of the clusters and hosts and of the tags of the hosts are cached
+    under cache_key, so they're only built again when the config changes. Hosts from
+    inventories change all the time, so they're added to the indexes once they're loaded.
+    """
+
+    def __init__(self, config, config_dir=None, cache_key=None):
+        # Clusters in the config file take precedence over the ones in the config directory
+        self.clusters = ChainMap((config or {}).get("clusters") or {}, config_dir or {})
+        self.cache_key = cache_key
+        self.host_strings = {}
+        self.cluster_name_index = None
+        self.host_name_index = None
+        self.hosts_by_name = None
+        self.tag_index = None
+        self.inventory_hosts = {}
+
+    def expand_cluster_names(self, cluster_names):
+        """
+        Returns the names of the clusters, where glob and /regex/ patterns are replaced by the
+        names of all clusters that match them. Ranges and braces are expanded like in hosts.
+        """
+        expanded = []
+        for cluster_name in expand_host_strings(cluster_names):
+            if not self.clusters:
+                click.echo("No clusters found in config file")
+                sys.exit(EXIT_CODE_NO_CLUSTERS)
+
+            if not is_pattern(cluster_name):
+                expanded.append(cluster_name)
+                continue
+
+            if self.cluster_name_index is None:
+                self.cluster_name_index = self.get_cached_index(
+                    "cluster-names", self.build_cluster_name_index
+                )
+            matches = self.cluster_name_index.match(cluster_name)
+            if not matches:
+                click.echo(f"No clusters match {cluster_name}")
+                sys.exit(EXIT_CODE_UNKNOWN_CLUSTER)
+            expanded += matches
+        return expanded
+
+    def match_hosts(self, pattern):
+        """
+        Returns the host strings of all hosts in all clusters whose hostname matches a pattern.
+        The index of all hosts is only built the first time it's needed.
+        """
+        if self.host_name_index is None:
+            self.host_name_index, self.hosts_by_name = self.get_cached_index(
+                "host-names", self.build_host_name_index
+            )
+
+            # Included hosts are defined by another cluster, so the hosts of every cluster
+            # and every inventory are all the hosts there are
+            new_names = set()
+            for host_string in self.get_inventory_host_strings():
+                hostname = parse_hostname(host_string)[1]
+                if hostname not in self.hosts_by_name:
+                    new_names.add(hostname)
+                self.hosts_by_name.setdefault(hostname, {})[host_string] = None
+            if new_names:
+                self.host_name_index.add(new_names)
+
+        return flatten(
+            [
+                list(self.hosts_by_name[name])
+                for name in self.host_name_index.match(pattern)
+            ]
+        )
+
+    def build_cluster_name_index(self):
+        """Returns the NameIndex of the names of all clusters"""
+        return NameIndex(self.clusters)
+
+    def build_host_name_index(self):
+        """
+        Returns the NameIndex of the hostnames of the hosts in the config, with a dict from
+        every hostname to the host strings that have it
+        """
+        hosts_by_name = {}
+        for cluster in self.clusters.values():
+            for entry in cluster.get("hosts") or []:
+                for host_string in expand_host_string(
+                    get_host_entry(entry)[0], check_size=False
+                ):
+                    hostname = parse_hostname(host_string)[1]
+                    hosts_by_name.setdefault(hostname, {})[host_string] = None
+        return NameIndex(hosts_by_name), hosts_by_name
+
+    def get_inventory_host_strings(self):
+        """
+        Returns the host strings of the inventories of all clusters, with the clusters that they
+        belong to
+        """
+        inventory_clusters = self.get_inventory_clusters()
+        self.prefetch(inventory_clusters)
+        return {
+            host_string: cluster_name
+            for cluster_name in inventory_clusters
+            for host_string in expand_host_strings(
+                self.inventory_hosts[get_inventory_source(self.clusters[cluster_name])],
+                check_size=False,
+            )
+        }
+
+    def get_inventory_clusters(self):
+        """Returns the names of the clusters that get their hosts from an inventory"""
+        return self.get_cached_index(
+            "inventory-clusters",
+            lambda: [
+                cluster_name
+                for cluster_name, cluster in self.clusters.items()
+                if get_inventory_source(cluster)
+            ],
+        )
+
+    def get_cached_index(self, name, build):
+        """
+        Returns an index of the config from the cache, or builds it with build and caches it if
+        it isn't cached for the current config
+        """
+        if self.cache_key is None:
+            return build()
+
+        cache_name = INDEX_CACHE.format(name)
+        cache = read_cache(cache_name)
+        if cache and cache["version"] == version() and cache["key"] == self.cache_key:
+            return cache["index"]
+
+        index = build()
+        write_cache(
+            cache_name, {"version": version(), "key": self.cache_key, "index": index}
+        )
+        return index
+
+    def get_host_strings(self, cluster_name, including=()):
+        """
+        Returns the host strings of a cluster, followed by the ones of the clusters it includes.
+        Hosts only appear once. including is the chain of clusters that include this cluster.
+        """
+        if cluster_name in self.host_strings:
+            return self.host_strings[cluster_name]
+
+        if cluster_name in including:
+            chain = " -> ".join(
+                including[including.index(cluster_name) :] + (cluster_name,)
+            )
+            click.echo(f"Cluster {cluster_name} includes itself: {chain}")
+            sys.exit(EXIT_CODE_INCLUDE_CYCLE)
+
+        if cluster_name not in self.clusters:
             click.echo(f"Cluster {cluster_name} not found")
             sys.exit(EXIT_CODE_UNKNOWN_CLUSTER)
 
-        host_strings = config["clusters"][cluster_name].get("hosts", [])
-        cluster_options = filter_valid_options(
-            config["clusters"][cluster_name], valid_options
+        cluster = self.clusters[cluster_name]
+        host_strings = list(
+            expand_host_strings(
+                (get_host_entry(entry)[0] for entry in cluster.get("hosts") or []),
+                check_size=False,
+            )
         )
+        if source := get_inventory_source(cluster):
+            self.prefetch([cluster_name])
+            host_strings += expand_host_strings(
+                self.inventory_hosts[source], check_size=False
+            )
+        for other_cluster in cluster.get("include_from") or []:
+            host_strings += self.get_host_strings(
+                other_cluster, including + (cluster_name,)
+            )
+
+        # A dict keeps the order, while dropping duplicates
+        self.host_strings[cluster_name] = list(dict.fromkeys(host_strings))
+        return self.host_strings[cluster_name]
+
+    def prefetch(self, cluster_names):
+        """
+        Fetch the hosts of the inventories of the clusters and the clusters they include.
+        Inventories that have never been cached are fetched concurrently.
+        """
+        from i2cssh.inventory import DEFAULT_TTLS, InventoryError, get_inventory_hosts
+
+        sources = {}
+        pending = list(cluster_names)
+        seen = set()
+        while pending:
+            cluster_name = pending.pop()
+            if cluster_name in seen or cluster_name not in self.clusters:
+                continue
+            seen.add(cluster_name)
+
+            cluster = self.clusters[cluster_name]
+            source = get_inventory_source(cluster)
+            if source and source not in self.inventory_hosts:
+                sources[source] = cluster.get("cache_ttl", DEFAULT_TTLS[source[0]])
+            pending += cluster.get("include_from") or []
+
+        if not sources:
+            return
+        try:
+            self.inventory_hosts.update(get_inventory_hosts(sources))
+        except InventoryError as exc:
+            click.echo(str(exc))
+            sys.exit(EXIT_CODE_INVENTORY_FAILED)
+
+    def get_tag_index(self):
+        """
+        Returns the TagIndex of all hosts in all clusters. Hosts from inventories get the tags
+        of their cluster and come after the hosts in the config.
+        """
+        if self.tag_index is None:
+            self.tag_index = self.get_cached_index("tags", self.build_tag_index)
+            inventory_host_strings = self.get_inventory_host_strings()
+            for host_string, cluster_name in inventory_host_strings.items():
+                cluster_tags = self.clusters[cluster_name].get("tags") or {}
+                self.tag_index.add(host_string, cluster_name, cluster_tags)
+        return self.tag_index
+
+    def build_tag_index(self):
+        """Returns the TagIndex of the hosts in the config"""
+        tag_index = TagIndex()
+        for cluster_name, cluster in self.clusters.items():
+            cluster_tags = cluster.get("tags") or {}
+            # Included hosts get their tags from the cluster that defines them
+            for entry in cluster.get("hosts") or []:
+                host_string, host_tags = get_host_entry(entry)
+                for host_string in expand_host_string(host_string, check_size=False):
+                    tag_index.add(
+                        host_string, cluster_name, {**cluster_tags, **host_tags}
+                    )
+        return tag_index
+
+
+def get_inventory_source(cluster):
+    """Returns the inventory source of a cluster (see i2cssh.inventory.get_source)"""
+    if not (cluster.get("hosts_command") or cluster.get("kubernetes")):
+        return None
+
+    from i2cssh.inventory import get_source
+
+    return get_source(cluster)
+
+
+def get_host_entry(entry):
+    """
+    Returns the host string and tags of an entry in the hosts of a cluster. An entry is either
+    a host string, or a host string that maps to the tags of the host.
+    """
+    if isinstance(entry, dict):
+        host_string, tags = next(iter(entry.items()))
+        return host_string, tags or {}
+    return entry, {}
+
+
+class TagIndex:
+    """
+    Inverted index from tags to the hosts that have them. Selections are answered by combining
+    the sets of hosts of the tags, rather than by looking at the tags of every host.
+    """
+
+    def __init__(self):
+        # All hosts with the cluster that defines them, in the order of the config
+        self.hosts = {}
+        self.hosts_by_tag = {}
+        self.hosts_by_key = {}
+
+    def add(self, host_string, cluster_name, tags):
+        """Add a host with its tags. A tag can have a list of values."""
+        self.hosts.setdefault(host_string, cluster_name)
+        for key, values in tags.items():
+            key = normalize_tag(key)
+            for value in values if isinstance(values, list) else [values]:
+                self.hosts_by_tag.setdefault((key, normalize_tag(value)), set()).add(
+                    host_string
+                )
+                self.hosts_by_key.setdefault(key, set()).add(host_string)
+
+    def select(self, selection):
+        """
+        Returns the host strings that match a selection, in the order of the config. Raises a
+        ValueError if the selection isn't valid.
+        """
+        selected = SelectionParser(selection, self).parse()
+        return [host_string for host_string in self.hosts if host_string in selected]
+
+
+def normalize_tag(tag):
+    """
+    Returns a tag key or value as it's looked up in a TagIndex. Booleans and null are written
+    the way YAML writes them, in the config as well as in a selection, so enabled: true in the
+    config matches enabled=true and enabled=True.
+    """
+    if tag is None:
+        return "null"
+    if isinstance(tag, bool):
+        return str(tag).lower()
+    tag = str(tag)
+    return YAML_CONSTANTS.get(tag.lower(), tag)
+
+
+class SelectionParser:
+    """
+    Parser for selections like 'role=db and (dc=ams or dc=fra) and not version=2', that
+    evaluates them to the set of hosts they select. Besides key=value, key!=value matches hosts
+    that don't have the tag, and key on its own matches hosts that have the key at all. not
+    binds stronger than and, which binds stronger than or.
+    """
 
-        # Include hosts from other clusters if specified. Note that
-        # the cluster options from the included cluster are ignored.
-        if other_clusters := config["clusters"][cluster_name].get("include_from"):
-            host_strings += flatten(
-                [config["clusters"][c]["hosts"] for c in other_clusters]
+    TOKEN = re.compile(r"\s*(\(|\)|!=|=|[^\s()!=]+)")
+
+    def __init__(self, selection, tag_index):
+        self.tag_index = tag_index
+        self.tokens = []
+        pos = 0
+        while selection[pos:].strip():
+            match = self.TOKEN.match(selection, pos)
+            if not match:
+                raise ValueError(f"unexpected '{selection[pos:].strip()}'")
+            self.tokens.append(match.group(1))
+            pos = match.end()
+        self.pos = 0
+
+    def parse(self):
+        selected = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f"unexpected '{self.peek()}'")
+        return selected
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("unexpected end of selection")
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        selected = self.parse_and()
+        while self.peek() == "or":
+            self.next()
+            selected = selected | self.parse_and()
+        return selected
+
+    def parse_and(self):
+        selected = self.parse_not()
+        while self.peek() == "and":
+            self.next()
+            selected = selected & self.parse_not()
+        return selected
+
+    def parse_not(self):
+        if self.peek() == "not":
+            self.next()
+            return set(self.tag_index.hosts) - self.parse_not()
+        return self.parse_term()
+
+    def parse_term(self):
+        token = self.next()
+        if token == "(":
+            selected = self.parse_or()
+            if self.next() != ")":
+                raise ValueError("missing ')'")
+            return selected
+        if token in (")", "=", "!=", "and", "or"):
+            raise ValueError(f"unexpected '{token}'")
+
+        key = normalize_tag(token)
+        if self.peek() not in ("=", "!="):
+            return set(self.tag_index.hosts_by_key.get(key, ()))
+        operator = self.next()
+        value = normalize_tag(self.next())
+        selected = set(self.tag_index.hosts_by_tag.get((key, value), ()))
+        if operator == "!=":
+            return set(self.tag_index.hosts) - selected
+        return selected
+
+
+def select_hosts(selection, cluster_index, valid_options):
+    """
+    Get the hosts of all clusters whose tags match a selection. Hosts get the options of the
+    cluster that defines them.
+    """
+    tag_index = cluster_index.get_tag_index()
+    try:
+        host_strings = tag_index.select(selection)
+    except ValueError as exc:
+        click.echo(f"Invalid selection: {exc}")
+        sys.exit(EXIT_CODE_INVALID_SELECTION)
+
+    if not host_strings:
+        click.echo(f"No hosts match {selection}")
+        sys.exit(EXIT_CODE_NO_HOSTS)
+
+    # Hosts of the same cluster share the options of that cluster
+    cluster_options = {}
+    hosts = []
+    for host_string in host_strings:
+        cluster_name = tag_index.hosts[host_string]
+        if cluster_name not in cluster_options:
+            cluster_options[cluster_name] = filter_valid_options(
+                cluster_index.clusters[cluster_name], valid_options
             )
+        hosts += host_strings_to_hosts([host_string], cluster_options[cluster_name])
+    return hosts
 
-        hosts = host_strings_to_hosts(host_strings)
 
-        # Override host options with cluster options
-        for host in hosts:
-            host["cluster_options"] = cluster_options
+class Host:
+    """
+    A host to connect to. A host only holds its hostname and the login from a login@hostname
+    string. All other options are looked up in options, which is shared by all hosts of a
+    cluster. Hosts can be read like the dicts of options they replace.
+    """
 
-        clusters.append(hosts)
-    return clusters
+    __slots__ = ("hostname", "login", "options")
+
+    def __init__(self, hostname, login=None, options=None):
+        self.hostname = hostname
+        self.login = login
+        self.options = {} if options is None else options
+
+    def get(self, key, default=None):
+        if key == "hostname":
+            return self.hostname
+        # The login of a host overrides the config, but not the command line, which is the
+        # first layer of the options
+        if key == "login" and self.login:
+            layers = getattr(self.options, "maps", ())
+            if not layers or "login" not in layers[0]:
+                return self.login
+        return self.options.get(key, default)
 
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
 
-def host_strings_to_hosts(host_strings):
-    """Get hosts from a list of hostname or login@hostname strings"""
+    def __repr__(self):
+        return f"Host({self.get('login')!r}, {self.hostname!r})"
+
+
+def host_strings_to_hosts(host_strings, cluster_options=None):
+    """
+    Get hosts from a list of hostname or login@hostname strings. All hosts share the same
+    cluster options.
+    """
+    if cluster_options is None:
+        cluster_options = {}
     hosts = []
     for host_string in host_strings:
         (login, hostname) = parse_hostname(host_string)
-        host = {"hostname": hostname, "login": login, "cluster_options": {}}
-        hosts.append(host)
+        hosts.append(Host(hostname, login, cluster_options))
     return hosts
 
 
-def apply_opts(target, overrides, valid_options):
+def layer_options(groups, global_opts, cmdline_opts, valid_options):
     """
-    Apply options from the config file and command line.
+    Replace the cluster options of all hosts by a chain of the command line options, the
+    cluster options and the global options. Hosts that share cluster options also share the
+    chain, so every layer is only filtered once per cluster.
     """
-    for key in valid_options:
-        if key in overrides and overrides[key] not in (None, ()):
-            target[key] = overrides[key]
+    cmdline_layer = get_option_layer(cmdline_opts, valid_options)
+    global_layer = get_option_layer(global_opts, valid_options)
+    chains = {}
+    for hosts in groups:
+        for host in hosts:
+            # The cluster options are kept with their chain, so their ids can't be reused
+            key = id(host.options)
+            if key not in chains:
+                chains[key] = host.options, ChainMap(
+                    cmdline_layer,
+                    get_option_layer(host.options, valid_options),
+                    global_layer,
+                )
+            host.options = chains[key][1]
+
+
+def get_option_layer(options, valid_options):
+    """
+    Get the valid options that are set. Options that are None or empty don't override the
+    options in lower layers.
+    """
+    return {
+        key: options[key]
+        for key in valid_options
+        if key in options and options[key] not in (None, ())
+    }
 
 
 def parse_hostname(hostname):
@@ -702,22 +2626,171 @@ def filter_valid_options(options, valid_options):
     return filtered_options
 
 
+@functools.lru_cache(maxsize=None)
+def default_shell():
+    """
+    Returns the name of the shell i2cssh is started from. Detecting it means walking the
+    process tree, so this is only done once, and only when no shell is configured.
+    """
+    import shellingham
+
+    try:
+        return shellingham.detect_shell()[0]
+    except shellingham.ShellDetectionFailure:
+        return "zsh"
+
+
 def read_config():
-    """Read the config file"""
+    """
+    Read the config file. The parsed config is cached, so the YAML only has to be parsed again
+    when the file changes.
+    """
     config_file = os.path.expanduser("~/.i2csshrc")
 
     # See if there's a config file and read from this first
-    if os.path.isfile(config_file):
-        with open(config_file, "r") as stream:
-            try:
-                return yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                click.echo("Error parsing config file:")
-                click.echo(exc)
-                sys.exit(EXIT_CODE_INVALID_YAML)
-    else:
+    if not os.path.isfile(config_file):
         return {}
 
+    # If the file has the same mtime and size as when it was cached, it doesn't even have to be
+    # read. Otherwise it's only parsed when its contents changed.
+    key = get_file_key(config_file)
+    cache = read_cache(CONFIG_CACHE)
+    if not (cache and cache["version"] == version() and cache["path"] == config_file):
+        cache = None
+    elif key is not None and cache["key"] == key:
+        return cache["config"]
+
+    import hashlib
+
+    with open(config_file, "r") as stream:
+        data = stream.read()
+    digest = hashlib.sha256(data.encode()).hexdigest()
+
+    if cache and cache["sha256"] == digest:
+        config = cache["config"]
+    else:
+        config = parse_config(data)
+
+    write_cache(
+        CONFIG_CACHE,
+        {
+            "version": version(),
+            "path": config_file,
+            "key": key,
+            "sha256": digest,
+            "config": config,
+        },
+    )
+    return config
+
+
+def parse_config(data):
+    """Parse the contents of a config file"""
+    import yaml
+
+    try:
+        # The C loader is a lot faster, but it's only available if PyYAML was built with libyaml
+        return yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    except yaml.YAMLError as exc:
+        click.echo("Error parsing config file:")
+        click.echo(exc)
+        sys.exit(EXIT_CODE_INVALID_YAML)
+
+
+def read_config_dir():
+    """
+    Returns the clusters that are defined in the files in the config directory, or None if there
+    is no config directory.
+    """
+    config_dir = os.path.expanduser("~/.i2csshrc.d")
+    if os.path.isdir(config_dir):
+        return ConfigDirectory(config_dir)
+    return None
+
+
+class ConfigDirectory(Mapping):
+    """
+    Clusters that are defined in the files in a config directory. Only the names of the clusters
+    are known up front; a file is only loaded once one of its clusters is needed. If more than
+    one file defines a cluster, the first file in alphabetical order wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = get_config_dir_index(path)
+        self.files = {}
+
+    def __getitem__(self, cluster_name):
+        config_file = self.index[cluster_name]
+        if config_file not in self.files:
+            self.files[config_file] = read_cluster_file(config_file)
+        return self.files[config_file][cluster_name]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def get_config_dir_index(path):
+    """
+    Returns a dict that maps the name of every cluster in a config directory to the file that
+    defines it. The names of the clusters in every file are cached, so only files that changed
+    have to be read.
+    """
+    cache = read_cache(CONFIG_DIR_CACHE)
+    if not (cache and cache["version"] == version() and cache["path"] == path):
+        cache = {"files": {}}
+
+    files = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(CONFIG_DIR_EXTENSIONS):
+            continue
+        config_file = os.path.join(path, name)
+        key = get_file_key(config_file)
+        entry = cache["files"].get(config_file)
+        if entry is None or key is None or entry["key"] != key:
+            entry = {"key": key, "clusters": list(read_cluster_file(config_file))}
+        files[config_file] = entry
+
+    if files != cache["files"]:
+        write_cache(
+            CONFIG_DIR_CACHE, {"version": version(), "path": path, "files": files}
+        )
+
+    index = {}
+    for config_file, entry in files.items():
+        for cluster_name in entry["clusters"]:
+            index.setdefault(cluster_name, config_file)
+    return index
+
+
+def read_cluster_file(config_file):
+    """
+    Read the clusters from a file in the config directory. Like the config file, the parsed
+    clusters are cached until the file changes.
+    """
+    import hashlib
+
+    cache_name = (
+        f"clusters-{hashlib.sha256(config_file.encode()).hexdigest()[:16]}.pickle"
+    )
+    key = get_file_key(config_file)
+    cache = read_cache(cache_name)
+    if (
+        cache
+        and cache["version"] == version()
+        and key is not None
+        and cache["key"] == key
+    ):
+        return cache["clusters"]
+
+    with open(config_file, "r") as stream:
+        clusters = (parse_config(stream.read()) or {}).get("clusters") or {}
+    write_cache(cache_name, {"version": version(), "key": key, "clusters": clusters})
+    return clusters
+
 
 def flatten(l):
     """Flatten a list of lists"""
@@ -1,17 +1,39 @@
 import asyncio
 import copy
+import io
+import itertools
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from email.policy import default
-from unittest.mock import ANY, AsyncMock, MagicMock, call, mock_open, patch
+from unittest.mock import ANY, DEFAULT, AsyncMock, MagicMock, call, mock_open, patch
 
+import click
 import pytest
 from click.testing import CliRunner
 
 import i2cssh
+import i2cssh.completion
+import i2cssh.inventory
 from i2cssh.lib import app
 from i2cssh.version import version
 
 
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """Give every test its own home and cache directory"""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    return tmp_path
+
+
 def test_help():
     runner = CliRunner()
     result = runner.invoke(app, ["--help"])
@@ -26,6 +48,79 @@ def test_version():
     assert result.output.startswith(version())
 
 
+# Maximum time that starting i2cssh may take on top of starting Python and importing click and
+# asyncio, which every launch needs
+STARTUP_BUDGET = 0.05
+
+# Maximum time that completing a cluster name may take on top of starting Python
+COMPLETION_BUDGET = 0.02
+
+
+def python_env():
+    """Environment for running python with this i2cssh, writing bytecode like an install does"""
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    path = os.path.dirname(os.path.dirname(i2cssh.__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [path, env.get("PYTHONPATH")]))
+    return env
+
+
+def startup_time(*args):
+    """Returns the best wall clock time of a few runs of python with args"""
+    env = python_env()
+    times = []
+    for _ in range(5):
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args], env=env, capture_output=True, check=True
+        )
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def test_import_is_light():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, i2cssh.lib; "
+            "print(*[m for m in ('iterm2', 'yaml', 'shellingham') "
+            "if m in sys.modules])",
+        ],
+        env=python_env(),
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+@pytest.mark.parametrize("option", ["--version", "--help"])
+def test_startup_budget(option):
+    baseline = startup_time("-c", "import asyncio, click")
+    assert startup_time("-m", "i2cssh.main", option) - baseline < STARTUP_BUDGET
+
+
+@patch("shellingham.detect_shell", return_value=("fish", "/usr/bin/fish"))
+def test_default_shell(mock_detect_shell: MagicMock):
+    i2cssh.lib.default_shell.cache_clear()
+    assert i2cssh.lib.default_shell() == "fish"
+
+    # The process tree is only walked once
+    assert i2cssh.lib.default_shell() == "fish"
+    mock_detect_shell.assert_called_once()
+
+
+@patch("shellingham.detect_shell")
+def test_default_shell_detection_failure(mock_detect_shell: MagicMock):
+    import shellingham
+
+    mock_detect_shell.side_effect = shellingham.ShellDetectionFailure()
+    i2cssh.lib.default_shell.cache_clear()
+    assert i2cssh.lib.default_shell() == "zsh"
+    i2cssh.lib.default_shell.cache_clear()
+
+
 @pytest.mark.asyncio
 @patch("asyncio.sleep", new_callable=AsyncMock)
 async def test_sleep(sleep_moc: AsyncMock):
@@ -33,24 +128,79 @@ async def test_sleep(sleep_moc: AsyncMock):
     sleep_moc.assert_called_once_with(1)
 
 
+def test_create_unused_lwop():
+    lwop = i2cssh.lib.create_unused_lwop()
+    assert "UNUSED" in lwop.values["Command"]
+    assert "cat > /dev/null" in lwop.values["Command"]
+    assert "Yes" in lwop.values["Custom Command"]
+    assert "Foreground Color" in lwop.values
+
+
+def screen_contents(lines, cursor_x, cursor_y, above=0):
+    contents = MagicMock()
+    contents.number_of_lines = len(lines)
+    contents.number_of_lines_above_screen = above
+    contents.cursor_coord.x = cursor_x
+    contents.cursor_coord.y = cursor_y + above
+    contents.line.side_effect = lambda i: MagicMock(string=lines[i])
+    return contents
+
+
+def test_has_prompt():
+    assert not i2cssh.lib.has_prompt(None)
+    assert not i2cssh.lib.has_prompt(screen_contents(["", ""], 0, 0))
+    assert not i2cssh.lib.has_prompt(
+        screen_contents(["Last login: Mon Oct 12 on ttys001", ""], 0, 1, above=10)
+    )
+    assert i2cssh.lib.has_prompt(
+        screen_contents(["Last login: Mon Oct 12 on ttys001", "~ % ", ""], 4, 1)
+    )
+
+
+class FakeScreenStreamer:
+    def __init__(self, updates):
+        self.updates = updates
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def async_get(self):
+        if not self.updates:
+            await asyncio.sleep(3600)
+        return self.updates.pop(0)
+
+
 @pytest.mark.asyncio
-@patch("asyncio.sleep", new_callable=AsyncMock)
-async def test_create_unused_pane(sleep_moc: AsyncMock):
-    pane = AsyncMock()
-    profile = AsyncMock()
-    pane.async_get_profile.return_value = profile
-    await i2cssh.lib.create_unused_pane(pane)
-    pane.async_get_profile.assert_called_once()
-    sleep_moc.assert_called_once_with(0.3)
-    profile.async_set_foreground_color.assert_called_once()
-    pane.async_send_text.assert_has_calls(
-        [
-            call("unset HISTFILE\n"),
-            call(
-                "stty -isig -icanon -echo && echo -e '\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\nUNUSED' && cat > /dev/null\n"
-            ),
-        ]
+async def test_wait_for_prompt():
+    pane = MagicMock()
+    pane.async_get_screen_contents = AsyncMock(return_value=screen_contents([""], 0, 0))
+    pane.get_screen_streamer.return_value = FakeScreenStreamer(
+        [screen_contents(["Last login", ""], 0, 1), screen_contents(["$ "], 2, 0)]
     )
+    assert await i2cssh.lib.wait_for_prompt(pane, 1)
+
+
+@pytest.mark.asyncio
+async def test_wait_for_prompt_timeout():
+    pane = MagicMock()
+    pane.async_get_screen_contents = AsyncMock(return_value=screen_contents([""], 0, 0))
+    pane.get_screen_streamer.return_value = FakeScreenStreamer([])
+    assert not await i2cssh.lib.wait_for_prompt(pane, 0.01)
+
+
+@pytest.mark.asyncio
+async def test_start_sessions_prompt_timeout():
+    hosts = [{"hostname": "foo1"}, {"hostname": "foo2"}]
+    with patch("i2cssh.lib.start_session") as mock_start_session, patch(
+        "i2cssh.lib.wait_for_prompt"
+    ) as mock_wait_for_prompt:
+        await i2cssh.lib.start_sessions(["p1", "p2", "p3"], hosts, None, 2.5)
+    mock_wait_for_prompt.assert_has_calls([call("p1", 2.5), call("p2", 2.5)])
+    assert mock_wait_for_prompt.call_count == 2
+    assert mock_start_session.call_count == 2
 
 
 @pytest.mark.asyncio
@@ -73,7 +223,269 @@ async def test_execute_command():
     pane = AsyncMock()
     cmd = MagicMock()
     await i2cssh.lib.execute_command(pane, cmd)
-    pane.async_send_text.assert_called_once_with(cmd)
+    pane.async_send_text.assert_called_once_with(cmd, suppress_broadcast=True)
+
+
+@pytest.mark.asyncio
+async def test_progressive_launch():
+    groups = [{"broadcast": True}, {"broadcast": True, "nobroadcast": True}]
+    panes = [AsyncMock() for _ in range(3)]
+    with patch("i2cssh.lib.enable_broadcast") as mock_enable_broadcast:
+        progress = i2cssh.lib.ProgressiveLaunch("connection", groups)
+        await progress.layout_built(0, panes[:2])
+        await progress.layout_built(1, panes[2:])
+
+        # Panes that join at the same time are sent in a single update
+        progress.session_started(0, panes[0])
+        progress.session_started(1, panes[2])
+        await asyncio.sleep(0)
+        progress.session_started(0, panes[1])
+        await progress.finish()
+
+    panes[0].async_activate.assert_called_once_with(select_tab=False)
+    panes[2].async_activate.assert_called_once_with(select_tab=True)
+    assert mock_enable_broadcast.call_args_list == [
+        call("connection", [[panes[0]]]),
+        call("connection", [panes[:2]]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_progressive_launch_no_broadcast():
+    with patch("i2cssh.lib.enable_broadcast") as mock_enable_broadcast:
+        progress = i2cssh.lib.ProgressiveLaunch("connection", [{}])
+        progress.session_started(0, AsyncMock())
+        await progress.finish()
+    mock_enable_broadcast.assert_called_once_with("connection", [])
+
+
+class FakePane:
+    """Pane that keeps track of its position in a unit square and its split depth"""
+
+    def __init__(self, x0=0.0, x1=1.0, y0=0.0, y1=1.0, depth=0, lwop=None):
+        self.x0, self.x1, self.y0, self.y1, self.depth = x0, x1, y0, y1, depth
+        self.lwop = lwop
+
+    def split(self, vertical, lwop=None):
+        if vertical:
+            mid = (self.x0 + self.x1) / 2
+            new_pane = FakePane(mid, self.x1, self.y0, self.y1, self.depth + 1, lwop)
+            self.x1 = mid
+        else:
+            mid = (self.y0 + self.y1) / 2
+            new_pane = FakePane(self.x0, self.x1, mid, self.y1, self.depth + 1, lwop)
+            self.y1 = mid
+        self.depth += 1
+        return new_pane
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cols,rows", [(1, 1), (2, 2), (3, 5), (10, 10), (7, 1)])
+async def test_split_grid(cols, rows):
+    async def split_pane(profile_name, lwop, vertical, pane):
+        return pane.split(vertical)
+
+    with patch("i2cssh.lib.split_pane", side_effect=split_pane) as mock_split_pane:
+        panes = await i2cssh.lib.split_grid(
+            "Default", [None] * (cols * rows), FakePane(), cols, rows, True
+        )
+
+    assert mock_split_pane.call_count == cols * rows - 1
+    # Panes are returned in row-major order
+    assert panes == sorted(panes, key=lambda p: (p.y0, p.x0))
+    assert len({(p.x0, p.y0) for p in panes}) == cols * rows
+    # Independent parts of the grid are split concurrently
+    assert max(p.depth for p in panes) <= math.ceil(math.log2(cols)) + math.ceil(
+        math.log2(rows)
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cols,rows", [(2, 2), (3, 5), (4, 3)])
+async def test_split_grid_lwops(cols, rows):
+    async def split_pane(profile_name, lwop, vertical, pane):
+        return pane.split(vertical, lwop)
+
+    with patch("i2cssh.lib.split_pane", side_effect=split_pane):
+        panes = await i2cssh.lib.split_grid(
+            "Default", list(range(cols * rows)), FakePane(lwop=0), cols, rows, False
+        )
+
+    # Every pane is created with the customizations for its position in the grid
+    assert [pane.lwop for pane in panes] == list(range(cols * rows))
+
+
+@pytest.mark.asyncio
+async def test_split_rows():
+    async def split_pane(profile_name, lwop, vertical, pane):
+        return pane.split(vertical, lwop)
+
+    with patch("i2cssh.lib.split_pane", side_effect=split_pane):
+        panes = await i2cssh.lib.split_rows(
+            "Default", list(range(8)), FakePane(lwop=0), [3, 3, 2], True
+        )
+
+    assert [pane.lwop for pane in panes] == list(range(8))
+    assert panes == sorted(panes, key=lambda p: (p.y0, p.x0))
+    # The panes in the last row are wider
+    assert panes[6].x1 - panes[6].x0 > panes[0].x1 - panes[0].x0
+
+
+def test_get_row_counts():
+    def group(hosts, rows, cols, fill_unused=None, explicit_rows=None):
+        return {
+            "hosts": [{}] * hosts,
+            "geometry": {"rows": rows, "cols": cols},
+            "fill_unused": fill_unused,
+            "rows": explicit_rows,
+        }
+
+    assert i2cssh.lib.get_row_counts(group(4, 2, 2)) == [2, 2]
+    assert i2cssh.lib.get_row_counts(group(7, 3, 3)) == [3, 3, 1]
+    assert i2cssh.lib.get_row_counts(group(4, 10, 1)) == [1, 1, 1, 1]
+    assert i2cssh.lib.get_row_counts(group(7, 3, 3, True)) == [3, 3, 3]
+
+    # An explicit number of rows is honored, even if the last rows get fewer panes
+    geometry = i2cssh.lib.compute_geometry(7, 5, None)
+    assert i2cssh.lib.get_row_counts(
+        group(7, geometry["rows"], geometry["cols"], explicit_rows=5)
+    ) == [2, 2, 1, 1, 1]
+    assert i2cssh.lib.get_row_counts(group(6, 3, 2, explicit_rows=3)) == [2, 2, 2]
+    assert i2cssh.lib.get_row_counts(group(2, 5, 1, explicit_rows=5)) == [1, 1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency,expected", [(None, 10), (1, 1), (3, 3)])
+async def test_start_sessions_concurrency(concurrency, expected):
+    running = 0
+    max_running = 0
+    started = []
+
+    async def start_session(pane, p, host_opts):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        started.append(p)
+        await asyncio.sleep(0)
+        running -= 1
+
+    hosts = [{"hostname": f"foo{i}"} for i in range(10)]
+    with patch("i2cssh.lib.start_session", side_effect=start_session):
+        await i2cssh.lib.start_sessions(list(range(10)), hosts, concurrency)
+
+    assert max_running == expected
+    assert started == list(range(10))
+
+
+@pytest.mark.asyncio
+@patch("i2cssh.lib.sleep", new_callable=AsyncMock)
+async def test_rate_limiter(sleep_mock: AsyncMock):
+    limiter = i2cssh.lib.RateLimiter(2, burst=3)
+    for _ in range(5):
+        await limiter.acquire()
+
+    # The first three sessions start right away, the others wait for their turn
+    waits = [c.args[0] for c in sleep_mock.call_args_list]
+    assert waits == pytest.approx([0.5, 1.0], abs=0.01)
+
+
+@pytest.mark.asyncio
+@patch("i2cssh.lib.sleep", new_callable=AsyncMock)
+async def test_rate_limiter_empty(sleep_mock: AsyncMock):
+    limiter = i2cssh.lib.RateLimiter(1, full=False)
+    await limiter.acquire()
+    await limiter.acquire()
+    waits = [c.args[0] for c in sleep_mock.call_args_list]
+    assert waits == pytest.approx([1.0, 2.0], abs=0.01)
+
+
+def test_rate_limiter_adaptive():
+    limiter = i2cssh.lib.RateLimiter(10, adaptive=True)
+    limiter.update(True)
+    assert limiter.rate == 5
+    limiter.update(True)
+    assert limiter.rate == 2.5
+    limiter.update(False)
+    assert limiter.rate == 3.5
+    for _ in range(20):
+        limiter.update(False)
+    assert limiter.rate == 10
+    for _ in range(20):
+        limiter.update(True)
+    assert limiter.rate == 0.5
+
+
+def test_create_rate_limiter():
+    assert i2cssh.lib.create_rate_limiter({}) is None
+
+    limiter = i2cssh.lib.create_rate_limiter({"rate": 5, "burst": 10})
+    assert (limiter.rate, limiter.burst, limiter.tokens) == (5, 10, 10)
+    assert not limiter.adaptive
+
+    limiter = i2cssh.lib.create_rate_limiter({"sleep": 0.5})
+    assert (limiter.rate, limiter.burst, limiter.tokens) == (2, 1, 0)
+
+    limiter = i2cssh.lib.create_rate_limiter({"adaptive": True})
+    assert limiter.rate == i2cssh.lib.DEFAULT_RATE
+    assert limiter.adaptive
+
+
+def test_shows_throttling():
+    contents = screen_contents(
+        [
+            "kex_exchange_identification: Connection closed by remote host",
+            "$ ssh foo1",
+            "",
+        ],
+        0,
+        2,
+        above=10,
+    )
+    assert i2cssh.lib.shows_throttling(contents, 10)
+    assert not i2cssh.lib.shows_throttling(contents, 11)
+    assert not i2cssh.lib.shows_throttling(None, 0)
+
+
+@pytest.mark.asyncio
+async def test_start_sessions_adaptive_retry():
+    limiter = i2cssh.lib.RateLimiter(10, burst=10, adaptive=True)
+    hosts = [{"hostname": "foo1"}, {"hostname": "foo2"}]
+    with patch("i2cssh.lib.start_session") as mock_start_session, patch(
+        "i2cssh.lib.watch_for_throttling", side_effect=[True, False, False]
+    ):
+        await i2cssh.lib.start_sessions(["p1", "p2"], hosts, 1, limiter=limiter)
+
+    # One of the sessions was throttled and started again
+    assert mock_start_session.call_count == 3
+    assert limiter.rate == 7
+
+
+@pytest.mark.asyncio
+async def test_launch_stats():
+    connection = MagicMock()
+
+    async def dispatch_until_id(reqid):
+        await asyncio.sleep(0)
+        return reqid
+
+    connection.async_dispatch_until_id = dispatch_until_id
+    stats = i2cssh.lib.LaunchStats()
+    stats.track(connection)
+
+    # Two requests after each other, then three pipelined requests
+    await connection.async_dispatch_until_id(1)
+    await connection.async_dispatch_until_id(2)
+    results = await asyncio.gather(
+        *[connection.async_dispatch_until_id(i) for i in range(3, 6)]
+    )
+
+    assert results == [3, 4, 5]
+    assert stats.requests == 5
+    assert stats.round_trips == 3
+    assert "5 iTerm2 requests in 3 round trips" in stats.report(2)
+    assert "saved" not in stats.report(2)
+    stats.saved = 0.5
+    assert stats.report(2).endswith("handshake saved 0.50s")
 
 
 def test_get_host_strs_from_file():
@@ -81,6 +493,55 @@ def test_get_host_strs_from_file():
         assert i2cssh.lib.get_host_strs_from_file("foo") == ["foo", "bar"]
 
 
+def test_get_host_strs_from_file_comments():
+    with patch("builtins.open", mock_open(read_data="foo\n\n  # bar\nbaz \n")):
+        assert i2cssh.lib.get_host_strs_from_file("foo") == ["foo", "baz"]
+
+
+def test_get_host_strs_from_stdin():
+    result = CliRunner().invoke(
+        click.command()(lambda: print(i2cssh.lib.get_host_strs_from_file("-"))),
+        input="foo\n#bar\nbaz\n",
+    )
+    assert result.output == "['foo', 'baz']\n"
+
+
+@pytest.mark.asyncio
+async def test_host_stream():
+    stream = i2cssh.lib.HostStream(io.StringIO("foo1\n\n# foo\nbar[1-3]\nbaz\n"), 3)
+    stream.template.options = {"login": "root"}
+    assert len(stream) == 3
+    assert [p async for p in stream.arrive()] == [0, 1, 2]
+    assert [i2cssh.lib.get_host_str(host) for host in stream] == [
+        "root@foo1",
+        "root@bar1",
+        "root@bar2",
+    ]
+
+    stream = i2cssh.lib.HostStream(io.StringIO("foo1\nbar[1-3]\n"), 10)
+    stream.hosts = i2cssh.lib.host_strings_to_hosts(["baz"])
+    assert len(stream) == 11
+    assert [p async for p in stream.arrive()] == [0, 1, 2, 3, 4]
+    assert len(stream) == 5
+    assert stream[1]["hostname"] == "foo1"
+
+
+@pytest.mark.asyncio
+async def test_host_stream_arrives_before_end():
+    r, w = os.pipe()
+    with open(r) as f, open(w, "w") as writer:
+        stream = i2cssh.lib.HostStream(f, 10)
+        writer.write("foo1\n")
+        writer.flush()
+
+        # The first host arrives while the second one hasn't been written yet
+        async for p in stream.arrive():
+            if p == 0:
+                writer.write("foo2\n")
+                writer.close()
+    assert [host["hostname"] for host in stream] == ["foo1", "foo2"]
+
+
 def invoke(args, config):
     with patch("i2cssh.lib.read_config") as mock_read_config, patch(
         "i2cssh.lib.get_window"
@@ -115,6 +576,842 @@ class TestReadConfig(unittest.TestCase):
         assert i2cssh.lib.read_config() == {"foo": "bar", "version": 2}
 
 
+@pytest.fixture
+def config_file(home):
+    config_file = home / ".i2csshrc"
+    config_file.write_text("version: 2\nclusters:\n  foo:\n    hosts: [foo1, foo2]\n")
+    return config_file
+
+
+def test_read_config_cache(config_file):
+    config = {"version": 2, "clusters": {"foo": {"hosts": ["foo1", "foo2"]}}}
+    assert i2cssh.lib.read_config() == config
+    assert i2cssh.lib.read_cache(i2cssh.lib.CONFIG_CACHE)["config"] == config
+
+    # Unchanged files aren't parsed or even read again
+    with patch("yaml.load") as mock_load, patch("hashlib.sha256") as mock_sha256:
+        assert i2cssh.lib.read_config() == config
+    mock_load.assert_not_called()
+    mock_sha256.assert_not_called()
+
+    # A file that was touched, but has the same contents, isn't parsed again
+    os.utime(config_file, ns=(0, 0))
+    with patch("yaml.load") as mock_load:
+        assert i2cssh.lib.read_config() == config
+    mock_load.assert_not_called()
+
+    config_file.write_text("version: 2\nclusters:\n  bar:\n    hosts: [bar1]\n")
+    os.utime(config_file, ns=(0, 0))
+    assert i2cssh.lib.read_config()["clusters"] == {"bar": {"hosts": ["bar1"]}}
+
+
+def test_read_config_cache_invalidated_by_version(config_file):
+    i2cssh.lib.read_config()
+    with patch("i2cssh.lib.version", return_value="0.0.0"), patch(
+        "yaml.load", return_value={}
+    ) as mock_load:
+        assert i2cssh.lib.read_config() == {}
+    mock_load.assert_called_once()
+
+
+def test_read_config_invalid_yaml_not_cached(config_file):
+    config_file.write_text("@")
+    with pytest.raises(SystemExit) as exc_info:
+        i2cssh.lib.read_config()
+    assert exc_info.value.code == 252
+    assert i2cssh.lib.read_cache(i2cssh.lib.CONFIG_CACHE) is None
+
+
+@pytest.fixture
+def config_dir(home):
+    config_dir = home / ".i2csshrc.d"
+    config_dir.mkdir()
+    (config_dir / "dc.yaml").write_text("clusters:\n  baz:\n    hosts: [baz1]\n")
+    (config_dir / "team.yml").write_text(
+        "clusters:\n  bar:\n    hosts: [bar1]\n    login: me\n  foo:\n    hosts: [foo3]\n"
+    )
+    (config_dir / "README").write_text("Not a config file")
+    return config_dir
+
+
+def test_config_dir(config_dir):
+    clusters = i2cssh.lib.read_config_dir()
+    assert sorted(clusters) == ["bar", "baz", "foo"]
+    assert clusters["bar"] == {"hosts": ["bar1"], "login": "me"}
+    assert list(clusters.files) == [str(config_dir / "team.yml")]
+
+    # Clusters in the config file take precedence
+    index = i2cssh.lib.ClusterIndex(
+        {"clusters": {"foo": {"hosts": ["foo1"]}}}, clusters
+    )
+    assert index.get_host_strings("foo") == ["foo1"]
+    assert index.get_host_strings("baz") == ["baz1"]
+
+
+def test_config_dir_missing():
+    assert i2cssh.lib.read_config_dir() is None
+
+
+def test_config_dir_cache(config_dir):
+    i2cssh.lib.read_config_dir()
+
+    # Nothing is parsed when none of the files changed
+    with patch("yaml.load") as mock_load:
+        clusters = i2cssh.lib.read_config_dir()
+        assert clusters["baz"] == {"hosts": ["baz1"]}
+    mock_load.assert_not_called()
+
+    # Only files that changed are parsed again
+    (config_dir / "dc.yaml").write_text("clusters:\n  qux:\n    hosts: [qux1]\n")
+    os.utime(config_dir / "dc.yaml", ns=(0, 0))
+    with patch("i2cssh.lib.parse_config", wraps=i2cssh.lib.parse_config) as mock_parse:
+        clusters = i2cssh.lib.read_config_dir()
+        assert sorted(clusters) == ["bar", "foo", "qux"]
+        assert clusters["qux"] == {"hosts": ["qux1"]}
+    mock_parse.assert_called_once()
+
+
+def test_complete(config_file, config_dir):
+    assert i2cssh.completion.complete("") == ["bar", "baz", "foo"]
+    assert i2cssh.completion.complete("b") == ["bar", "baz"]
+    assert i2cssh.completion.complete("foo,ba") == ["foo,bar", "foo,baz"]
+    assert i2cssh.completion.complete("x") == []
+
+
+def test_complete_stale_index(config_file):
+    assert i2cssh.completion.complete("") == ["foo"]
+
+    # A changed config is picked up in the background, while the index answers right away
+    config_file.write_text("clusters:\n  foo: {}\n  foobar: {}\n")
+    with patch("i2cssh.completion.refresh_in_background") as mock_refresh, patch(
+        "i2cssh.lib.read_config"
+    ) as mock_read_config:
+        assert i2cssh.completion.complete("foo") == ["foo"]
+    mock_refresh.assert_called_once()
+    mock_read_config.assert_not_called()
+
+    i2cssh.completion.main(["--refresh"])
+    assert i2cssh.completion.complete("foo") == ["foo", "foobar"]
+
+
+def test_complete_invalid_config(config_file, capsys):
+    config_file.write_text("@")
+    assert i2cssh.completion.complete("") == []
+    assert capsys.readouterr().out == ""
+
+    # The invalid config is only read once, until it changes
+    with patch("i2cssh.completion.refresh_in_background") as mock_refresh, patch(
+        "i2cssh.lib.read_config"
+    ) as mock_read_config:
+        assert i2cssh.completion.complete("") == []
+    mock_refresh.assert_not_called()
+    mock_read_config.assert_not_called()
+
+
+def test_completion_main(config_file, capsys):
+    i2cssh.completion.main(["--", "f"])
+    assert capsys.readouterr().out == "foo\n"
+    i2cssh.completion.main(["--shell", "zsh"])
+    assert "compdef _i2cssh i2cssh" in capsys.readouterr().out
+    with pytest.raises(SystemExit) as exc_info:
+        i2cssh.completion.main(["foo", "bar"])
+    assert exc_info.value.code == 2
+
+
+def test_completion_budget(config_file):
+    args = ["-m", "i2cssh.completion", "--", "f"]
+    subprocess.run([sys.executable, *args], env=python_env(), check=True)
+    baseline = startup_time("-c", "pass")
+    assert startup_time(*args) - baseline < COMPLETION_BUDGET
+
+
+def test_name_index():
+    index = i2cssh.lib.NameIndex(
+        ["db-1-eu", "db-2-us", "db-3-eu", "web-a1", "web-b2", "web-c3", "api"]
+    )
+    assert index.match("db-*-eu") == ["db-1-eu", "db-3-eu"]
+    assert index.match("web-?[12]") == ["web-a1", "web-b2"]
+    assert index.match("/^web-(a|b)/") == ["web-a1", "web-b2"]
+    assert index.match("/eu$/") == ["db-1-eu", "db-3-eu"]
+    assert index.match("nope*") == []
+
+    # Only names with the literal prefix of the pattern are matched
+    assert index.candidates("db-*-eu") == ["db-1-eu", "db-2-us", "db-3-eu"]
+    assert index.candidates("/^web-(a|b)/") == ["web-a1", "web-b2", "web-c3"]
+    assert len(index.candidates("/eu$/")) == 7
+
+
+@pytest.mark.parametrize(
+    "pattern,prefix",
+    [
+        ("db-*", "db-"),
+        ("*db", ""),
+        ("db[12]", "db"),
+        ("/^web-(a|b)/", "web-"),
+        ("/^web-?x/", "web"),
+        ("/^web\\d/", "web"),
+        ("/^a|b/", ""),
+        ("/web/", ""),
+    ],
+)
+def test_get_literal_prefix(pattern, prefix):
+    assert i2cssh.lib.get_literal_prefix(pattern) == prefix
+
+
+tagged_config = {
+    "clusters": {
+        "db-ams": {
+            "tags": {"role": "db", "dc": "ams"},
+            "hosts": ["db1", {"db2": {"version": 2}}],
+            "login": "dba",
+        },
+        "db-fra": {"tags": {"role": "db", "dc": "fra"}, "hosts": ["db3"]},
+        "web": {
+            "tags": {"role": "web", "dc": ["ams", "fra"]},
+            "hosts": ["web1"],
+            "include_from": ["db-ams"],
+        },
+    }
+}
+
+
+@pytest.mark.parametrize(
+    "selection,host_strings",
+    [
+        ("role=db and dc=ams", ["db1", "db2"]),
+        ("role=db and dc=ams or role=web", ["db1", "db2", "web1"]),
+        ("dc=fra", ["db3", "web1"]),
+        ("role=db and not dc=ams", ["db3"]),
+        ("role!=db", ["web1"]),
+        ("version", ["db2"]),
+        ("version=2", ["db2"]),
+        ("role=db and (dc=fra or version=2)", ["db2", "db3"]),
+        ("role=cache", []),
+    ],
+)
+def test_tag_index_select(selection, host_strings):
+    tag_index = i2cssh.lib.ClusterIndex(tagged_config).get_tag_index()
+    assert tag_index.select(selection) == host_strings
+
+
+@pytest.mark.parametrize(
+    "selection,host_strings",
+    [
+        ("enabled=true", ["web1"]),
+        ("enabled=True", ["web1"]),
+        ("enabled=false", ["db1"]),
+        ("owner=null", ["db1"]),
+        ("owner=None", ["db1"]),
+        ("port=22", ["web1"]),
+    ],
+)
+def test_tag_index_select_yaml_values(selection, host_strings):
+    tag_index = i2cssh.lib.TagIndex()
+    tag_index.add("web1", "web", {"enabled": True, "port": 22})
+    tag_index.add("db1", "db", {"enabled": False, "owner": None})
+    assert tag_index.select(selection) == host_strings
+
+
+@pytest.mark.parametrize(
+    "selection",
+    ["role=", "role=db and", "(role=db", "role=db)", "=db", "role=db dc=ams"],
+)
+def test_tag_index_select_invalid(selection):
+    tag_index = i2cssh.lib.ClusterIndex(tagged_config).get_tag_index()
+    with pytest.raises(ValueError):
+        tag_index.select(selection)
+
+
+def test_cluster_index_cache(home):
+    index = i2cssh.lib.ClusterIndex(tagged_config, cache_key="key")
+    assert index.expand_cluster_names(["db-*"]) == ["db-ams", "db-fra"]
+    assert index.match_hosts("db*") == ["db1", "db2", "db3"]
+    assert index.get_tag_index().select("role=web") == ["web1"]
+
+    # With the same key, the indexes come from the cache rather than from the clusters
+    with patch.object(
+        i2cssh.lib.ClusterIndex, "build_cluster_name_index"
+    ) as mock_cluster_names, patch.object(
+        i2cssh.lib.ClusterIndex, "build_host_name_index"
+    ) as mock_host_names, patch.object(
+        i2cssh.lib.ClusterIndex, "build_tag_index"
+    ) as mock_tags:
+        index = i2cssh.lib.ClusterIndex(tagged_config, cache_key="key")
+        assert index.expand_cluster_names(["db-*"]) == ["db-ams", "db-fra"]
+        assert index.match_hosts("db*") == ["db1", "db2", "db3"]
+        assert index.get_tag_index().select("role=web") == ["web1"]
+    mock_cluster_names.assert_not_called()
+    mock_host_names.assert_not_called()
+    mock_tags.assert_not_called()
+
+    # A different key means the config changed
+    config = {"clusters": {"db-new": {"hosts": ["db9"], "tags": {"role": "web"}}}}
+    index = i2cssh.lib.ClusterIndex(config, cache_key="other")
+    assert index.expand_cluster_names(["db-*"]) == ["db-new"]
+    assert index.match_hosts("db*") == ["db9"]
+    assert index.get_tag_index().select("role=web") == ["db9"]
+
+
+@pytest.mark.usefixtures("kubectl")
+def test_cluster_index_cache_inventory(home):
+    config = {
+        "clusters": {
+            "web": {"hosts": ["web1"], "tags": {"role": "web"}},
+            "pods": {"kubernetes": {"selector": "app=web"}, "tags": {"role": "web"}},
+        }
+    }
+    (home / "pods.json").write_text(json.dumps({"items": [pod("web-pod1")]}))
+    index = i2cssh.lib.ClusterIndex(config, cache_key="key")
+    assert index.match_hosts("web*") == ["web-pod1", "web1"]
+    assert index.get_tag_index().select("role=web") == ["web1", "web-pod1"]
+
+    # Hosts of inventories aren't part of the cached indexes
+    for name in os.listdir(home / "cache" / "i2cssh"):
+        if name.startswith("inventory-"):
+            os.unlink(home / "cache" / "i2cssh" / name)
+    (home / "pods.json").write_text(json.dumps({"items": [pod("web-pod2")]}))
+    index = i2cssh.lib.ClusterIndex(config, cache_key="key")
+    assert index.match_hosts("web*") == ["web-pod2", "web1"]
+    assert index.get_tag_index().select("role=web") == ["web1", "web-pod2"]
+
+
+def test_split_list():
+    assert i2cssh.lib.split_list("foo,bar") == ["foo", "bar"]
+    assert i2cssh.lib.split_list("foo,/^db{1,3}/,b*") == ["foo", "/^db{1,3}/", "b*"]
+    assert i2cssh.lib.split_list("{a,b}-db,c[1-2]") == ["{a,b}-db", "c[1-2]"]
+
+
+@pytest.mark.parametrize(
+    "host_string,host_strings",
+    [
+        ("web1", ["web1"]),
+        ("web[1-3]", ["web1", "web2", "web3"]),
+        ("web[08-10].dc1", ["web08.dc1", "web09.dc1", "web10.dc1"]),
+        ("web[1-10:4]", ["web1", "web5", "web9"]),
+        ("web[3-1]", ["web3", "web2", "web1"]),
+        ("{a,b}-db", ["a-db", "b-db"]),
+        ("root@{a,b[1-2]}-db", ["root@a-db", "root@b1-db", "root@b2-db"]),
+        ("{root,admin}@db[1-2]", ["root@db1", "root@db2", "admin@db1", "admin@db2"]),
+        ("web[1-2:0]", ["web[1-2:0]"]),
+        ("/^web{1,3}/", ["/^web{1,3}/"]),
+    ],
+)
+def test_expand_host_string(host_string, host_strings):
+    assert list(i2cssh.lib.expand_host_string(host_string)) == host_strings
+
+
+def test_host_expansion_is_lazy():
+    expansion = i2cssh.lib.HostExpansion("web[0000001-9999999].dc[1-3]")
+    assert len(expansion) == 9999999 * 3
+    assert list(itertools.islice(expansion, 4)) == [
+        "web0000001.dc1",
+        "web0000001.dc2",
+        "web0000001.dc3",
+        "web0000002.dc1",
+    ]
+
+
+def test_expand_host_string_too_many(capsys):
+    # The size of the expansion is known without generating a single host string
+    with patch.object(i2cssh.lib.HostExpansion, "__iter__") as mock_iter:
+        with pytest.raises(SystemExit) as exc_info:
+            i2cssh.lib.expand_host_string("web[1-100000000]")
+        assert exc_info.value.code == i2cssh.lib.EXIT_CODE_TOO_MANY_HOSTS
+        assert "web[1-100000000] expands to 100000000 hosts" in capsys.readouterr().out
+
+        # Unless only a few of them are used
+        i2cssh.lib.expand_host_string("web[1-100000000]", limit=3)
+    mock_iter.assert_called_once()
+
+    hosts = i2cssh.lib.get_hosts(["web[1-100000000]"], limit=3)
+    assert [host["hostname"] for host in hosts] == ["web1", "web2", "web3"]
+
+
+def test_layer_options():
+    valid_options = ["login", "rows", "profile", "broadcast"]
+    foo = i2cssh.lib.host_strings_to_hosts(
+        ["foo1", "dba@foo2"], {"login": "foo", "rows": 2, "broadcast": None}
+    )
+    bar = i2cssh.lib.host_strings_to_hosts(["bar1"])
+    i2cssh.lib.layer_options(
+        [foo, bar],
+        {"login": "global", "rows": 1, "broadcast": True},
+        {"profile": "cli", "rows": None},
+        valid_options,
+    )
+
+    assert [host.get("login") for host in foo + bar] == ["foo", "dba", "global"]
+    assert [host["rows"] for host in foo + bar] == [2, 2, 1]
+    assert [host.get("profile") for host in foo + bar] == ["cli"] * 3
+    assert foo[0].get("broadcast") is True
+    assert foo[0]["hostname"] == "foo1"
+    with pytest.raises(KeyError):
+        foo[0]["extra"]
+
+    # Hosts of a cluster share their options, hosts only hold their own fields
+    assert foo[0].options is foo[1].options
+    assert foo[0].options is not bar[0].options
+    assert not hasattr(foo[0], "__dict__")
+
+
+def test_layer_options_cli_login():
+    hosts = i2cssh.lib.host_strings_to_hosts(["foo1", "dba@foo2"], {"login": "foo"})
+    i2cssh.lib.layer_options([hosts], {}, {"login": "cli"}, ["login"])
+    assert [i2cssh.lib.get_host_str(host) for host in hosts] == ["cli@foo1", "cli@foo2"]
+
+
+def test_inventory_command():
+    source = ("command", "printf 'web1\\n\\n# web\\nroot@web2\\n'")
+    assert i2cssh.inventory.get_inventory_hosts({source: 60}) == {
+        source: ["web1", "root@web2"]
+    }
+
+    # Fresh hosts come from the cache
+    cached = i2cssh.inventory.read_cache(i2cssh.inventory.get_cache_name(source))
+    assert cached[1] == ["web1", "root@web2"]
+    with patch("subprocess.Popen") as mock_popen:
+        assert i2cssh.inventory.get_inventory_hosts({source: 60}) == {
+            source: ["web1", "root@web2"]
+        }
+    mock_popen.assert_not_called()
+
+
+@patch("i2cssh.inventory.refresh_in_background")
+def test_inventory_command_stale(mock_refresh: MagicMock):
+    source = ("command", "false")
+    i2cssh.inventory.write_cache(
+        i2cssh.inventory.get_cache_name(source), (time.time() - 120, ["web1"])
+    )
+
+    # Stale hosts are used right away, while the command is refreshed in the background
+    assert i2cssh.inventory.get_inventory_hosts({source: 60}) == {source: ["web1"]}
+    mock_refresh.assert_called_once_with(source)
+
+    mock_refresh.reset_mock()
+    assert i2cssh.inventory.get_inventory_hosts({source: 300}) == {source: ["web1"]}
+    mock_refresh.assert_not_called()
+
+
+def test_inventory_command_failed():
+    with pytest.raises(
+        i2cssh.inventory.InventoryError, match="'echo oops >&2; false'.*oops"
+    ):
+        i2cssh.inventory.get_inventory_hosts({("command", "echo oops >&2; false"): 60})
+
+
+def test_inventory_commands_run_concurrently():
+    sources = {("command", f"sleep 1; echo web{i}"): 60 for i in range(3)}
+    started = time.monotonic()
+    assert list(i2cssh.inventory.get_inventory_hosts(sources).values()) == [
+        ["web0"],
+        ["web1"],
+        ["web2"],
+    ]
+    assert time.monotonic() - started < 2
+
+
+def test_inventory_commands_with_large_output():
+    # The second command fills its pipe long before the first one is done
+    sources = {
+        ("command", "sleep 1; echo web1"): 60,
+        ("command", "yes web | head -n 100000; sleep 1"): 60,
+    }
+    started = time.monotonic()
+    host_strings = list(i2cssh.inventory.get_inventory_hosts(sources).values())
+    assert host_strings[0] == ["web1"]
+    assert len(host_strings[1]) == 100000
+    assert time.monotonic() - started < 1.8
+
+
+def test_inventory_command_failed_kills_others():
+    ok, failed, slow = (
+        ("command", "echo web1"),
+        ("command", "sleep 0.2; false"),
+        ("command", "sleep 30; echo web3"),
+    )
+    started = time.monotonic()
+    with pytest.raises(i2cssh.inventory.InventoryError, match="false"):
+        i2cssh.inventory.get_inventory_hosts({ok: 60, failed: 60, slow: 60})
+    assert time.monotonic() - started < 5
+
+    # The hosts of the command that succeeded are still cached
+    assert i2cssh.inventory.read_cache(i2cssh.inventory.get_cache_name(ok))[1] == [
+        "web1"
+    ]
+    assert i2cssh.inventory.read_cache(i2cssh.inventory.get_cache_name(slow)) is None
+
+
+def test_inventory_refresh_once():
+    source = ("command", "echo web1")
+    with patch("subprocess.Popen") as mock_popen:
+        i2cssh.inventory.refresh_in_background(source)
+        i2cssh.inventory.refresh_in_background(source)
+    mock_popen.assert_called_once()
+
+    # A refresh that's done lets the next one start
+    i2cssh.inventory.main(list(source))
+    with patch("subprocess.Popen") as mock_popen:
+        i2cssh.inventory.refresh_in_background(source)
+    mock_popen.assert_called_once()
+
+    # A refresh that never finished doesn't block refreshes forever
+    marker = i2cssh.inventory.get_refresh_marker(source)
+    old = time.time() - i2cssh.inventory.REFRESH_TIMEOUT - 1
+    os.utime(marker, (old, old))
+    with patch("subprocess.Popen") as mock_popen:
+        i2cssh.inventory.refresh_in_background(source)
+    mock_popen.assert_called_once()
+
+
+def test_inventory_refresh():
+    # The background refresh is a separate process that writes the cache
+    env = python_env()
+    subprocess.run(
+        [sys.executable, "-m", "i2cssh.inventory", "command", "echo web1"],
+        env=env,
+        check=True,
+    )
+    source = ("command", "echo web1")
+    assert i2cssh.inventory.get_inventory_hosts({source: 60}) == {source: ["web1"]}
+
+
+def pod(name, phase="Running", **metadata):
+    return {"metadata": {"name": name, **metadata}, "status": {"phase": phase}}
+
+
+@pytest.fixture
+def kubectl(home, monkeypatch):
+    """A kubectl on the PATH that logs its arguments and lists the pods in ~/pods.json"""
+    bin_dir = home / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "kubectl").write_text(
+        '#!/bin/sh\necho "$@" >> "$HOME/kubectl.log"\ncat "$HOME/pods.json"\n'
+    )
+    (bin_dir / "kubectl").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    (home / "pods.json").write_text(
+        json.dumps(
+            {
+                "items": [
+                    pod("api-1"),
+                    pod("api-2"),
+                    pod("api-3", "Pending"),
+                    pod("api-4", deletionTimestamp="2024-01-01T00:00:00Z"),
+                ]
+            }
+        )
+    )
+    return home / "kubectl.log"
+
+
+def test_kubectl_command():
+    assert i2cssh.inventory.get_kubectl_command({"namespace": "prod"}) == (
+        "kubectl get pods -o json --namespace prod"
+    )
+    assert i2cssh.inventory.get_kubectl_command(
+        {"context": "eu", "namespace": "prod", "selector": "app=api,tier in (web)"}
+    ) == (
+        "kubectl get pods -o json --context eu --namespace prod "
+        "--selector 'app=api,tier in (web)'"
+    )
+
+
+def test_kubernetes_pods(kubectl):
+    source = i2cssh.inventory.get_source(
+        {"kubernetes": {"namespace": "prod", "selector": "app=api"}}
+    )
+    assert i2cssh.inventory.get_inventory_hosts({source: 30}) == {
+        source: ["api-1", "api-2"]
+    }
+    assert (
+        kubectl.read_text() == "get pods -o json --namespace prod --selector app=api\n"
+    )
+
+
+def test_kubernetes_invalid_output(kubectl):
+    (kubectl.parent / "pods.json").write_text("error")
+    source = i2cssh.inventory.get_source({"kubernetes": {"namespace": "prod"}})
+    with pytest.raises(i2cssh.inventory.InventoryError, match="invalid output"):
+        i2cssh.inventory.get_inventory_hosts({source: 30})
+
+
+@pytest.fixture
+def ports():
+    """A port that accepts connections and a port that refuses them"""
+    with socket.socket() as listening, socket.socket() as closed:
+        listening.bind(("127.0.0.1", 0))
+        listening.listen()
+        closed.bind(("127.0.0.1", 0))
+        yield listening.getsockname()[1], closed.getsockname()[1]
+
+
+def test_get_ssh_port():
+    assert i2cssh.lib.get_ssh_port({}) == 22
+    assert i2cssh.lib.get_ssh_port({"extra": {"p": 2222, "i": "id.pem"}}) == 2222
+    assert i2cssh.lib.get_ssh_port({"extra": ("i=id.pem", "p=2222")}) == 2222
+    assert i2cssh.lib.get_ssh_port({"extra": ("C",)}) == 22
+
+
+@pytest.mark.asyncio
+async def test_probe_hosts(ports):
+    up, down = ports
+    hosts = [
+        {"hostname": "127.0.0.1", "extra": {"p": up}},
+        {"hostname": "127.0.0.1", "extra": {"p": down}},
+        {"hostname": "127.0.0.1", "extra": {"p": down}, "gateway": "bastion"},
+        {
+            "hostname": "127.0.0.1",
+            "extra": {"p": down},
+            "custom_command": "echo {host}",
+        },
+    ]
+    assert await i2cssh.lib.probe_hosts(hosts, 1) == [True, False, True, True]
+
+
+def test_get_ssh_target():
+    assert i2cssh.lib.get_ssh_target(
+        "user me\nhostname 10.0.0.1\nport 2222\nproxycommand none\n"
+    ) == ("10.0.0.1", 2222)
+    assert i2cssh.lib.get_ssh_target("hostname web1\nproxyjump bastion\n") is None
+    assert i2cssh.lib.get_ssh_target("hostname web1\nproxycommand nc %h %p\n") is None
+
+
+@pytest.mark.asyncio
+async def test_probe_hosts_ssh_config(home, monkeypatch, ports):
+    up, down = ports
+    bin_dir = home / "bin"
+    bin_dir.mkdir()
+    # An ssh that resolves hosts like ~/.ssh/config would
+    (bin_dir / "ssh").write_text(
+        "#!/bin/sh\n"
+        "for host; do :; done\n"
+        'case "$host" in\n'
+        f"  alias) printf 'hostname 127.0.0.1\\nport {up}\\n' ;;\n"
+        f"  jumped) printf 'hostname 127.0.0.1\\nport {down}\\nproxyjump b\\n' ;;\n"
+        "  *) exit 255 ;;\n"
+        "esac\n"
+    )
+    (bin_dir / "ssh").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    hosts = [
+        {"hostname": "alias"},
+        {"hostname": "jumped"},
+        # If ssh can't resolve a host, it's probed as it is
+        {"hostname": "127.0.0.1", "extra": {"p": down}},
+    ]
+    assert await i2cssh.lib.probe_hosts(hosts, 1) == [True, True, False]
+
+
+@pytest.mark.asyncio
+async def test_probe_hosts_timeout():
+    started = time.monotonic()
+
+    async def hang(*_):
+        await asyncio.sleep(10)
+
+    with patch("asyncio.open_connection", side_effect=hang):
+        reachable = await i2cssh.lib.probe_hosts(
+            [{"hostname": f"host{i}"} for i in range(4)], 0.1, concurrency=2
+        )
+    assert reachable == [False] * 4
+    assert time.monotonic() - started < 1
+
+
+def test_skip_unreachable_summary(capsys):
+    groups = [
+        i2cssh.lib.host_strings_to_hosts([f"web{i}" for i in range(12)]),
+        i2cssh.lib.host_strings_to_hosts(["db1", "db2"]),
+    ]
+    reachable = [False] * 12 + [True, False]
+    # Like planning, probing runs in its own thread with its own event loop
+    with patch("i2cssh.lib.probe_hosts", AsyncMock(return_value=reachable)):
+        with ThreadPoolExecutor(1) as executor:
+            groups = executor.submit(i2cssh.lib.skip_unreachable, groups, 1).result()
+
+    assert [[host["hostname"] for host in hosts] for hosts in groups] == [["db1"]]
+    assert capsys.readouterr().err == (
+        "Skipping 13 unreachable hosts: "
+        + ", ".join(f"web{i}" for i in range(10))
+        + " and 3 more\n"
+    )
+
+
+def test_create_ssh_prefix_control_path():
+    assert i2cssh.lib.create_ssh_prefix(True, None, None, "/tmp/cm-%C") == (
+        'ssh -A -o ControlPath="/tmp/cm-%C"'
+    )
+
+
+def test_get_master_command(home):
+    control_path = home / "cache" / "i2cssh" / "cm-%C"
+    assert i2cssh.lib.get_control_path({"prewarm": True}) == str(control_path)
+    assert i2cssh.lib.get_control_path({}) is None
+    assert i2cssh.lib.get_control_path({"prewarm": True, "custom_command": "x"}) is None
+
+    host = {"hostname": "foo1", "login": "root", "prewarm": True, "extra": ("p=2222",)}
+    assert i2cssh.lib.get_master_command(host) == (
+        f'ssh -p 2222 -o ControlPath="{control_path}" -o ControlMaster=auto '
+        "-o ControlPersist=600 -o BatchMode=yes -N -f root@foo1"
+    )
+
+
+def test_get_master_command_without_forwards(home):
+    control_path = home / "cache" / "i2cssh" / "cm-%C"
+    master = (
+        f'-o ControlPath="{control_path}" -o ControlMaster=auto '
+        "-o ControlPersist=600 -o BatchMode=yes -N -f foo1"
+    )
+    host = {
+        "hostname": "foo1",
+        "prewarm": True,
+        "forward_agent": True,
+        "extra": (
+            "L=8080:localhost:80",
+            "R=9090:localhost:90",
+            "D=1080",
+            "t",
+            "o=LocalForward 8081 localhost:81",
+            "o=RequestTTY=yes",
+            "p=2222",
+        ),
+    }
+    assert i2cssh.lib.get_master_command(host) == f"ssh -p 2222 {master}"
+
+    host["extra"] = {"L": "8080:localhost:80", "o": "ForwardAgent=yes", "p": 2222}
+    assert i2cssh.lib.get_master_command(host) == f"ssh -p 2222 {master}"
+
+    # The sessions still get them
+    assert i2cssh.lib.create_ssh_prefix(True, host["extra"], None) == (
+        "ssh -A -L 8080:localhost:80 -o ForwardAgent=yes -p 2222"
+    )
+
+
+def test_get_proxy_command():
+    assert i2cssh.lib.get_proxy_command("bar") == "ssh -W %h:%p bar"
+    assert i2cssh.lib.get_proxy_command("a@hop1, b@hop2,bar") == (
+        "ssh -J a@hop1,b@hop2 -W %h:%p bar"
+    )
+    assert i2cssh.lib.get_proxy_command("bar", "/tmp/cm-%C") == (
+        "ssh -o ControlPath='/tmp/cm-%%C' -W %h:%p bar"
+    )
+    assert i2cssh.lib.create_ssh_prefix(False, None, "bar", None, "/tmp/a b/cm-%C") == (
+        "ssh -o ProxyCommand=\"ssh -o ControlPath='/tmp/a b/cm-%%C' -W %h:%p bar\""
+    )
+
+
+def test_get_gateway_master_command(home):
+    control_path = home / "cache" / "i2cssh" / "cm-%C"
+    host = {"hostname": "foo1", "gateway": "hop1,bar", "gateway_mux": True}
+    assert i2cssh.lib.get_gateway_control_path(host) == str(control_path)
+    assert i2cssh.lib.get_gateway_control_path({"gateway": "bar"}) is None
+    assert i2cssh.lib.get_gateway_control_path({"gateway_mux": True}) is None
+
+    assert i2cssh.lib.get_gateway_master_command(host) == (
+        f'ssh -o ControlPath="{control_path}" -J hop1 -o ControlMaster=auto '
+        "-o ControlPersist=600 -o BatchMode=yes -N -f bar"
+    )
+    assert i2cssh.lib.create_ssh_prefix(
+        False, None, "hop1,bar", None, str(control_path)
+    ) == (
+        f"ssh -o ProxyCommand=\"ssh -o ControlPath='{str(control_path).replace('%', '%%')}' "
+        '-J hop1 -W %h:%p bar"'
+    )
+
+
+def master_process(hangs=False):
+    """A process for ssh that exits right away, or hangs until it's killed"""
+    process = MagicMock()
+    killed = asyncio.Event()
+    process.kill.side_effect = killed.set
+
+    async def wait():
+        if hangs:
+            await killed.wait()
+
+    process.wait.side_effect = wait
+    return process
+
+
+@pytest.mark.asyncio
+async def test_open_control_masters(home):
+    hosts = [
+        {"hostname": "foo1", "prewarm": True},
+        {"hostname": "foo1", "prewarm": True},
+        {"hostname": "foo2", "prewarm": True},
+        {"hostname": "foo3"},
+        {"hostname": "foo4", "prewarm": True, "custom_command": "echo {host}"},
+    ]
+    with patch(
+        "asyncio.create_subprocess_shell", return_value=master_process()
+    ) as mock_shell:
+        masters = i2cssh.lib.open_control_masters(hosts, 2)
+        await asyncio.gather(*masters.values())
+
+    # Every host gets a single connection
+    assert [c.args[0] for c in mock_shell.call_args_list] == [
+        i2cssh.lib.get_master_command(hosts[0]),
+        i2cssh.lib.get_master_command(hosts[2]),
+    ]
+    assert (home / "cache" / "i2cssh").is_dir()
+
+
+@pytest.mark.asyncio
+async def test_open_control_masters_gateway_mux(home):
+    hosts = [
+        {"hostname": "foo1", "gateway": "bar", "gateway_mux": True, "prewarm": True},
+        {"hostname": "foo2", "gateway": "bar", "gateway_mux": True, "prewarm": True},
+        {"hostname": "foo3", "gateway": "baz", "gateway_mux": True},
+        {"hostname": "foo4", "gateway": "qux"},
+    ]
+    with patch(
+        "asyncio.create_subprocess_shell", return_value=master_process()
+    ) as mock_shell:
+        masters = i2cssh.lib.open_control_masters(hosts, 2)
+        await asyncio.gather(*masters.values())
+
+    # A single connection per gateway, which is up before the hosts connect through it
+    assert [c.args[0] for c in mock_shell.call_args_list] == [
+        i2cssh.lib.get_gateway_master_command(hosts[0]),
+        i2cssh.lib.get_gateway_master_command(hosts[2]),
+        i2cssh.lib.get_master_command(hosts[0]),
+        i2cssh.lib.get_master_command(hosts[1]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_open_control_masters_timeout():
+    # The first connection hangs, the others are up right away
+    processes = [master_process(hangs=True), master_process(), master_process()]
+    hosts = [{"hostname": f"foo{i}", "prewarm": True} for i in range(3)]
+    started = time.monotonic()
+    with patch("asyncio.create_subprocess_shell", side_effect=processes):
+        masters = i2cssh.lib.open_control_masters(hosts, 2, timeout=0.1)
+        await asyncio.gather(*masters.values())
+
+    assert time.monotonic() - started < 1
+    processes[0].kill.assert_called_once()
+    processes[1].kill.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_open_control_masters_without_prewarm():
+    with patch("asyncio.create_subprocess_shell") as mock_shell:
+        masters = i2cssh.lib.open_control_masters([{"hostname": "foo1"}], None)
+    assert masters == {}
+    mock_shell.assert_not_called()
+
+
+def test_read_cache_corrupt(tmp_path):
+    (tmp_path / "cache" / "i2cssh").mkdir(parents=True)
+    (tmp_path / "cache" / "i2cssh" / "foo").write_bytes(b"garbage")
+    assert i2cssh.lib.read_cache("foo") is None
+    i2cssh.lib.write_cache("foo", {"foo": 1})
+    assert i2cssh.lib.read_cache("foo") == {"foo": 1}
+    assert os.listdir(tmp_path / "cache" / "i2cssh") == ["foo"]
+
+
 default_config = {
     "clusters": {
         "foo": {
@@ -124,13 +1421,17 @@ default_config = {
 }
 
 
-def assert_options(mec, options, hosts=["foo1", "foo2"], extra_calls=[]):
+def assert_options(mec, options, hosts=["foo1", "foo2"], prefixes=None):
     if options:
         options = f"{options} "
 
-    calls = [call(ANY, f"unset HISTFILE && ssh {options}{host}\n") for host in hosts]
-    if len(extra_calls) > 0:
-        calls += [call(ANY, extra_call) for extra_call in extra_calls]
+    if prefixes is None:
+        prefixes = [""] * len(hosts)
+
+    calls = [
+        call(ANY, f"{prefix}unset HISTFILE && ssh {options}{host}\n")
+        for prefix, host in zip(prefixes, hosts)
+    ]
 
     mec.assert_has_calls(
         calls,
@@ -179,6 +1480,37 @@ class TestParams(unittest.TestCase):
             result = runner.invoke(app, ["-c", "foo"])
             assert result.exit_code == 253
 
+    def test_no_hosts_no_current_window_cli(self, mec: MagicMock):
+        with patch("i2cssh.lib.read_config") as mock_read_config, patch(
+            "i2cssh.lib.get_window"
+        ) as mock_get_window, patch(
+            "iterm2.run_until_complete", run_until_complete_mock
+        ):
+            mock_read_config.return_value = default_config
+            mock_get_window.return_value = None
+            runner = CliRunner()
+            result = runner.invoke(app)
+            assert result.exit_code == 255
+
+    def test_planning_overlaps_handshake(self, mec: MagicMock):
+        requested = threading.Event()
+
+        def read_config():
+            # Planning can only finish once the window has been requested from iTerm2
+            assert requested.wait(5)
+            return default_config
+
+        def get_window(connection):
+            requested.set()
+            return DEFAULT
+
+        with patch("i2cssh.lib.read_config", side_effect=read_config), patch(
+            "i2cssh.lib.get_window", side_effect=get_window
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["foo"])
+        assert result.exit_code == 0
+        assert_options(mec, "")
+
     def test_clusters_cli(self, mec: MagicMock):
         invoke(["-c", "foo"], default_config)
         assert_options(mec, "")
@@ -203,6 +1535,64 @@ class TestParams(unittest.TestCase):
         mock_create_window.assert_called_once()
         self.assertEqual(mock_create_tab.call_count, 0)
 
+    def test_concurrency_across_tabs_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "foo": {"hosts": ["foo1", "foo2", "foo3"]},
+                "bar": {"hosts": ["bar1", "bar2", "bar3"]},
+            }
+        }
+        running = 0
+        max_running = 0
+
+        async def start_session(pane, p, host_opts):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        with patch("i2cssh.lib.start_session", side_effect=start_session) as mock:
+            invoke(["-c", "foo,bar", "-t", "-j", "2"], config)
+        self.assertEqual(mock.call_count, 6)
+        self.assertEqual(max_running, 2)
+
+    @patch("i2cssh.lib.build_group")
+    def test_tab_split_groups_built_concurrently(
+        self, mock_build_group: MagicMock, mec: MagicMock
+    ):
+        config = {
+            "clusters": {
+                "foo": {"hosts": ["foo1", "foo2"]},
+                "bar": {"hosts": ["bar1", "bar2"]},
+                "baz": {"hosts": ["baz1", "baz2"]},
+            }
+        }
+        running = 0
+        max_running = 0
+
+        async def build_group(
+            group, session, lwops, limiter, on_layout, on_started, masters, semaphore
+        ):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0)
+            running -= 1
+            return [AsyncMock()]
+
+        mock_build_group.side_effect = build_group
+        invoke(["-c", "foo,bar,baz", "-t"], config)
+        self.assertEqual(mock_build_group.call_count, 3)
+        self.assertEqual(max_running, 3)
+        self.assertEqual(
+            [
+                c.args[0]["hosts"][0]["hostname"]
+                for c in mock_build_group.call_args_list
+            ],
+            ["foo1", "bar1", "baz1"],
+        )
+
     def test_include_from(self, mec: MagicMock):
         config = {
             "clusters": {
@@ -217,6 +1607,291 @@ class TestParams(unittest.TestCase):
         }
         invoke(["foo"], config)
         assert_options(mec, "", ["foo1", "foo2", "bar1", "bar2"])
+        self.assertEqual(config["clusters"]["foo"]["hosts"], ["foo1", "foo2"])
+
+    def test_config_dir_cli(self, mec: MagicMock):
+        config_dir = os.path.join(os.environ["HOME"], ".i2csshrc.d")
+        os.mkdir(config_dir)
+        with open(os.path.join(config_dir, "team.yml"), "w") as f:
+            f.write("clusters:\n  bar:\n    include_from: [foo]\n    hosts: [bar1]\n")
+        invoke(["bar", "-A"], default_config)
+        assert_options(mec, "-A", ["bar1", "foo1", "foo2"])
+
+    def test_cluster_glob_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "db-1-eu": {"hosts": ["db1"]},
+                "db-2-us": {"hosts": ["db2"]},
+                "db-3-eu": {"hosts": ["db3"]},
+            }
+        }
+        invoke(["-c", "db-*-eu"], config)
+        assert_options(mec, "", ["db1", "db3"])
+        self.assertEqual(mec.call_count, 2)
+
+    def test_cluster_regex_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "web-a": {"hosts": ["web1"]},
+                "web-b": {"hosts": ["web2"]},
+                "web-c": {"hosts": ["web3"]},
+            }
+        }
+        invoke(["/^web-(a|b)/"], config)
+        assert_options(mec, "", ["web1", "web2"])
+        self.assertEqual(mec.call_count, 2)
+
+    def test_cluster_pattern_no_match_cli(self, mec: MagicMock):
+        with patch("i2cssh.lib.read_config", return_value=default_config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["-c", "db-*"])
+        self.assertEqual(result.exit_code, 254)
+        self.assertIn("No clusters match db-*", result.output)
+
+    def test_host_pattern_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "foo": {"hosts": ["web1", "root@db1"]},
+                "bar": {"hosts": ["web2", "db2"], "include_from": ["foo"]},
+            }
+        }
+        invoke(["-m", "db*,other"], config)
+        assert_options(mec, "", ["root@db1", "db2", "other"])
+        self.assertEqual(mec.call_count, 3)
+
+        mec.reset_mock()
+        invoke(["-m", "me@/^web[12]$/"], config)
+        assert_options(mec, "", ["me@web1", "me@web2"])
+        self.assertEqual(mec.call_count, 2)
+
+    def test_invalid_pattern_cli(self, mec: MagicMock):
+        with patch("i2cssh.lib.read_config", return_value=default_config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["-c", "/web(/"])
+            self.assertEqual(result.exit_code, 247)
+            self.assertIn("Invalid pattern /web(/", result.output)
+            result = CliRunner().invoke(app, ["-m", "/x(/"])
+            self.assertEqual(result.exit_code, 247)
+            self.assertIn("Invalid pattern /x(/", result.output)
+        mec.assert_not_called()
+
+    def test_too_many_hosts_cli(self, mec: MagicMock):
+        with patch("i2cssh.lib.read_config", return_value=default_config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["-m", "a[1-100000000]"])
+        self.assertEqual(result.exit_code, 246)
+        self.assertIn("expands to 100000000 hosts", result.output)
+        mec.assert_not_called()
+
+    def test_big_cluster_cli(self, mec: MagicMock):
+        # A big cluster in the config doesn't stop patterns and selections of other hosts
+        config = copy.deepcopy(tagged_config)
+        config["clusters"]["big"] = {"tags": {"role": "batch"}, "hosts": ["b[1-5000]"]}
+        invoke(["-m", "db*"], config)
+        assert_options(mec, "", ["db1", "db2", "db3"])
+
+        mec.reset_mock()
+        invoke(["--select", "role=web"], config)
+        assert_options(mec, "", ["web1"])
+        self.assertEqual(mec.call_count, 1)
+
+        # And can itself still be expanded
+        self.assertEqual(
+            len(i2cssh.lib.ClusterIndex(config).get_host_strings("big")), 5000
+        )
+
+    def test_host_pattern_no_match_cli(self, mec: MagicMock):
+        with patch("i2cssh.lib.read_config", return_value=default_config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["-m", "db*"])
+        self.assertEqual(result.exit_code, 255)
+
+    def test_select_cli(self, mec: MagicMock):
+        invoke(["--select", "role=db and dc=ams"], tagged_config)
+        assert_options(mec, "", ["dba@db1", "dba@db2"])
+        self.assertEqual(mec.call_count, 2)
+
+        # Hosts with tags can be used like any other host
+        mec.reset_mock()
+        invoke(["web"], tagged_config)
+        assert_options(mec, "", ["web1", "db1", "db2"])
+
+    def test_select_invalid_cli(self, mec: MagicMock):
+        with patch("i2cssh.lib.read_config", return_value=tagged_config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["--select", "role=db and"])
+            self.assertEqual(result.exit_code, 249)
+            result = CliRunner().invoke(app, ["--select", "role=cache"])
+            self.assertEqual(result.exit_code, 255)
+
+    def test_hosts_command_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "web": {
+                    "hosts_command": "echo web1; echo web2",
+                    "login": "www",
+                    "tags": {"role": "web"},
+                },
+                "db": {"hosts": ["db1"], "hosts_command": "echo 'db[2-3]'"},
+                "all": {"include_from": ["web", "db"]},
+            }
+        }
+        invoke(["-c", "web,db"], config)
+        assert_options(mec, "", ["www@web1", "www@web2", "db1", "db2", "db3"])
+
+        mec.reset_mock()
+        invoke(["all"], config)
+        assert_options(mec, "", ["web1", "web2", "db1", "db2", "db3"])
+
+        # Hosts from a command can be selected like any other host
+        mec.reset_mock()
+        invoke(["--select", "role=web", "-m", "db[2-3]"], config)
+        assert_options(mec, "", ["www@web1", "www@web2", "db2", "db3"])
+
+    def test_hosts_command_failed_cli(self, mec: MagicMock):
+        config = {"clusters": {"web": {"hosts_command": "exit 3"}}}
+        with patch("i2cssh.lib.read_config", return_value=config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["web"])
+        self.assertEqual(result.exit_code, 248)
+        self.assertIn("'exit 3' failed: exit status 3", result.output)
+
+    @pytest.mark.usefixtures("kubectl")
+    def test_kubernetes_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "api": {
+                    "kubernetes": {"namespace": "prod", "selector": "app=api"},
+                    "custom_command": "kubectl exec -it {host} -n prod -- /bin/bash",
+                },
+                "api-debug": {
+                    "kubernetes": {"namespace": "prod", "selector": "app=api"},
+                    "custom_command": "kubectl debug -it {host} -n prod",
+                },
+            }
+        }
+        invoke(["-c", "api,api-debug"], config)
+        mec.assert_has_calls(
+            [
+                call(
+                    ANY,
+                    " unset HISTFILE && kubectl exec -it api-1 -n prod -- /bin/bash\n",
+                ),
+                call(
+                    ANY,
+                    " unset HISTFILE && kubectl exec -it api-2 -n prod -- /bin/bash\n",
+                ),
+                call(ANY, " unset HISTFILE && kubectl debug -it api-1 -n prod\n"),
+                call(ANY, " unset HISTFILE && kubectl debug -it api-2 -n prod\n"),
+            ],
+            any_order=True,
+        )
+
+        # Both clusters have the same selector, so the pods were only listed once
+        kubectl_log = os.path.join(os.environ["HOME"], "kubectl.log")
+        with open(kubectl_log) as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_probe_cli(self, mec: MagicMock):
+        with socket.socket() as listening, socket.socket() as closed:
+            listening.bind(("127.0.0.1", 0))
+            listening.listen()
+            closed.bind(("127.0.0.1", 0))
+            up, down = listening.getsockname()[1], closed.getsockname()[1]
+            config = {
+                "clusters": {
+                    "up": {"hosts": ["127.0.0.1"], "extra": {"p": up}},
+                    "down": {"hosts": ["127.0.0.1"], "extra": {"p": down}},
+                }
+            }
+            result = invoke(
+                ["-c", "up,down", "--probe", "--probe-timeout", "1"], config
+            )
+
+        self.assertEqual(mec.call_count, 1)
+        self.assertIn(f"-p {up} 127.0.0.1", mec.call_args.args[1])
+        self.assertIn("Skipping 1 unreachable hosts: 127.0.0.1", result.output)
+
+    def test_host_ranges_cli(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "web-ams": {"hosts": ["web[01-02].ams", "root@db{1,2}"]},
+                "web-fra": {"hosts": ["web[1-5:4].fra"]},
+            }
+        }
+        invoke(["-c", "web-{ams,fra}"], config)
+        assert_options(
+            mec,
+            "",
+            ["web01.ams", "web02.ams", "root@db1", "root@db2", "web1.fra", "web5.fra"],
+        )
+        self.assertEqual(mec.call_count, 6)
+
+        mec.reset_mock()
+        invoke(["-m", "me@{a,b}[1-2],c"], config)
+        assert_options(mec, "", ["me@a1", "me@a2", "me@b1", "me@b2", "c"])
+        self.assertEqual(mec.call_count, 5)
+
+    def test_include_from_transitive(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "foo": {"include_from": ["bar", "baz"], "hosts": ["foo1"]},
+                "bar": {"include_from": ["baz"], "hosts": ["bar1", "foo1"]},
+                "baz": {"hosts": ["baz1"]},
+            }
+        }
+        invoke(["foo"], config)
+        assert_options(mec, "", ["foo1", "bar1", "baz1"])
+        self.assertEqual(mec.call_count, 3)
+
+    def test_include_from_cycle(self, mec: MagicMock):
+        config = {
+            "clusters": {
+                "foo": {"include_from": ["bar"], "hosts": ["foo1"]},
+                "bar": {"include_from": ["baz"], "hosts": ["bar1"]},
+                "baz": {"include_from": ["bar"], "hosts": ["baz1"]},
+            }
+        }
+        with patch("i2cssh.lib.read_config", return_value=config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["foo"])
+        self.assertEqual(result.exit_code, 250)
+        self.assertIn("bar -> baz -> bar", result.output)
+
+    def test_include_from_unknown_cluster(self, mec: MagicMock):
+        config = {"clusters": {"foo": {"include_from": ["bar"], "hosts": ["foo1"]}}}
+        with patch("i2cssh.lib.read_config", return_value=config), patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            result = CliRunner().invoke(app, ["foo"])
+        self.assertEqual(result.exit_code, 254)
+
+    def test_cluster_index_memoized(self, mec: MagicMock):
+        index = i2cssh.lib.ClusterIndex(
+            {
+                "clusters": {
+                    "foo": {"include_from": ["shared"]},
+                    "bar": {"include_from": ["shared"]},
+                    "shared": {"hosts": ["shared1", "shared2"]},
+                }
+            }
+        )
+        clusters = i2cssh.lib.get_clusters_from_cluster_names(
+            ["foo", "bar", "foo"], index, []
+        )
+        self.assertEqual(
+            [[host["hostname"] for host in hosts] for hosts in clusters],
+            [["shared1", "shared2"]] * 3,
+        )
+        # Every cluster was resolved once
+        self.assertEqual(list(index.host_strings), ["shared", "foo", "bar"])
 
     @patch("i2cssh.lib.create_tab")
     @patch("i2cssh.lib.create_window")
@@ -466,7 +2141,11 @@ class TestParams(unittest.TestCase):
 
     def test_environment_cli(self, mec: MagicMock):
         invoke(["foo", "-e", "LC_FOO=foo,LC_BAR=bar"], default_config)
-        assert_options(mec, "-o SendEnv=LC_FOO,LC_BAR")
+        assert_options(
+            mec,
+            "-o SendEnv=LC_FOO,LC_BAR",
+            prefixes=["export LC_FOO=foo; export LC_BAR=bar;\n"] * 2,
+        )
 
     def test_environment_cluster_config(self, mec: MagicMock):
         config = copy.deepcopy(default_config)
@@ -475,7 +2154,7 @@ class TestParams(unittest.TestCase):
         assert_options(
             mec,
             "-o SendEnv=LC_FOO,LC_BAR",
-            extra_calls=["export LC_FOO=foo; export LC_BAR=bar;\n"],
+            prefixes=["export LC_FOO=foo; export LC_BAR=bar;\n"] * 2,
         )
 
     def test_environment_global_config(self, mec: MagicMock):
@@ -485,7 +2164,7 @@ class TestParams(unittest.TestCase):
         assert_options(
             mec,
             "-o SendEnv=LC_FOO,LC_BAR",
-            extra_calls=["export LC_FOO=foo; export LC_BAR=bar;\n"],
+            prefixes=["export LC_FOO=foo; export LC_BAR=bar;\n"] * 2,
         )
 
     def test_rank_cli(self, mec: MagicMock):
@@ -493,7 +2172,7 @@ class TestParams(unittest.TestCase):
         assert_options(
             mec,
             "-o SendEnv=LC_RANK",
-            extra_calls=["export LC_RANK=0;\n", "export LC_RANK=1;\n"],
+            prefixes=["export LC_RANK=0;\n", "export LC_RANK=1;\n"],
         )
 
     def test_rank_cluster_config(self, mec: MagicMock):
@@ -503,7 +2182,7 @@ class TestParams(unittest.TestCase):
         assert_options(
             mec,
             "-o SendEnv=LC_RANK",
-            extra_calls=["export LC_RANK=0;\n", "export LC_RANK=1;\n"],
+            prefixes=["export LC_RANK=0;\n", "export LC_RANK=1;\n"],
         )
 
     def test_rank_global_config(self, mec: MagicMock):
@@ -513,7 +2192,7 @@ class TestParams(unittest.TestCase):
         assert_options(
             mec,
             "-o SendEnv=LC_RANK",
-            extra_calls=["export LC_RANK=0;\n", "export LC_RANK=1;\n"],
+            prefixes=["export LC_RANK=0;\n", "export LC_RANK=1;\n"],
         )
 
     def test_extra_cli(self, mec: MagicMock):
@@ -554,6 +2233,39 @@ class TestParams(unittest.TestCase):
         invoke(["foo"], config)
         assert_options(mec, '-o ProxyCommand="ssh -W %h:%p bar"')
 
+    def test_gateway_chain_cli(self, mec: MagicMock):
+        invoke(["foo", "-g", "hop1,bar"], default_config)
+        assert_options(mec, '-o ProxyCommand="ssh -J hop1 -W %h:%p bar"')
+
+    def test_gateway_mux_cli(self, mec: MagicMock):
+        control_path = os.path.join(os.environ["XDG_CACHE_HOME"], "i2cssh", "cm-%C")
+        with patch(
+            "asyncio.create_subprocess_shell", return_value=master_process()
+        ) as mock_shell:
+            invoke(["foo", "-g", "bar", "--gateway-mux"], default_config)
+
+        self.assertEqual(
+            [c.args[0] for c in mock_shell.call_args_list],
+            [
+                f'ssh -o ControlPath="{control_path}" -o ControlMaster=auto '
+                "-o ControlPersist=600 -o BatchMode=yes -N -f bar"
+            ],
+        )
+        proxy_path = control_path.replace("%", "%%")
+        assert_options(
+            mec, f"-o ProxyCommand=\"ssh -o ControlPath='{proxy_path}' -W %h:%p bar\""
+        )
+
+    def test_gateway_mux_cluster_config(self, mec: MagicMock):
+        config = copy.deepcopy(default_config)
+        config["clusters"]["foo"]["gateway"] = "bar"
+        config["clusters"]["foo"]["gateway_mux"] = True
+        with patch(
+            "asyncio.create_subprocess_shell", return_value=master_process()
+        ) as mock_shell:
+            invoke(["foo"], config)
+        self.assertEqual(len(mock_shell.call_args_list), 1)
+
     def test_custom_command_cli(self, mec: MagicMock):
         invoke(["foo", "-x mycmd {host} -- bla"], default_config)
 
@@ -591,6 +2303,87 @@ class TestParams(unittest.TestCase):
             any_order=True,
         )
 
+    @patch("i2cssh.lib.set_broadcast_domains")
+    def test_stats_cli(self, mock_broadcast: MagicMock, mec: MagicMock):
+        result = invoke(["foo", "--stats"], default_config)
+        assert_options(mec, "")
+        self.assertIn("Launched 2 panes in", result.output)
+
+    @patch("i2cssh.lib.enable_broadcast")
+    def test_progressive_cli(self, mock_enable_broadcast: MagicMock, mec: MagicMock):
+        invoke(["foo", "-P", "-b"], default_config)
+        assert_options(mec, "")
+        panes = [c.args[0] for c in mec.call_args_list]
+        self.assertEqual(mock_enable_broadcast.call_args_list[-1], call(ANY, [panes]))
+
+    @patch("i2cssh.lib.set_broadcast_domains")
+    def test_stats_off_cli(self, mock_broadcast: MagicMock, mec: MagicMock):
+        with patch("i2cssh.lib.LaunchStats.track") as mock_track:
+            result = invoke(["foo"], default_config)
+        self.assertNotIn("Launched", result.output)
+
+        # The connection is left alone without --stats
+        mock_track.assert_not_called()
+
+    @patch("i2cssh.lib.set_broadcast_domains")
+    def test_stats_global_config(self, mock_broadcast: MagicMock, mec: MagicMock):
+        config = copy.deepcopy(default_config)
+        config["stats"] = True
+        with patch("i2cssh.lib.LaunchStats.track") as mock_track:
+            result = invoke(["foo"], config)
+        self.assertIn("Launched 2 panes in", result.output)
+        mock_track.assert_called_once()
+
+    @patch("i2cssh.lib.create_lwop")
+    def test_direct_cli(self, mock_lwop: MagicMock, mec: MagicMock):
+        invoke(["foo", "-D", "-A"], default_config)
+        mock_lwop.assert_has_calls(
+            [
+                call("ssh -A -o ControlMaster=no foo1"),
+                call("ssh -A -o ControlMaster=no foo2"),
+            ],
+            any_order=True,
+        )
+        self.assertEqual(mec.call_count, 0)
+
+    @patch("i2cssh.lib.create_lwop")
+    def test_direct_environment_cli(self, mock_lwop: MagicMock, mec: MagicMock):
+        invoke(["foo", "-D", "-r"], default_config)
+        mock_lwop.assert_has_calls(
+            [
+                call(
+                    "/usr/bin/env LC_RANK=0 ssh -o ControlMaster=no -o SendEnv=LC_RANK foo1"
+                ),
+                call(
+                    "/usr/bin/env LC_RANK=1 ssh -o ControlMaster=no -o SendEnv=LC_RANK foo2"
+                ),
+            ],
+            any_order=True,
+        )
+
+    @patch("i2cssh.lib.create_lwop")
+    def test_direct_custom_command_global_config(
+        self, mock_lwop: MagicMock, mec: MagicMock
+    ):
+        config = copy.deepcopy(default_config)
+        config["direct"] = True
+        config["custom_command"] = "mycmd {host} -- bla"
+        invoke(["foo"], config)
+        mock_lwop.assert_has_calls(
+            [call("mycmd foo1 -- bla"), call("mycmd foo2 -- bla")], any_order=True
+        )
+        self.assertEqual(mec.call_count, 0)
+
+    @patch("i2cssh.lib.create_unused_lwop")
+    @patch("i2cssh.lib.create_lwop")
+    def test_direct_fill_unused(
+        self, mock_lwop: MagicMock, mock_unused_lwop: MagicMock, mec: MagicMock
+    ):
+        config = {"clusters": {"foo": {"hosts": ["foo1", "foo2", "foo3"]}}}
+        invoke(["foo", "-D", "-U"], config)
+        mock_unused_lwop.assert_called_once()
+        self.assertEqual(mec.call_count, 0)
+
     @patch("i2cssh.lib.set_fullscreen")
     def test_fullscreen_on_cli(self, mock_fullscreen: MagicMock, mec: MagicMock):
         invoke(["-c", "foo", "-F"], default_config)
@@ -651,6 +2444,58 @@ class TestParams(unittest.TestCase):
             any_order=True,
         )
 
+    def test_prewarm_exec_cli(self, mec: MagicMock):
+        control_path = os.path.join(os.environ["XDG_CACHE_HOME"], "i2cssh", "cm-%C")
+        with patch(
+            "asyncio.create_subprocess_shell", return_value=master_process()
+        ) as mock_shell:
+            invoke(["foo", "-E", "--prewarm"], default_config)
+
+        self.assertEqual(
+            [c.args[0] for c in mock_shell.call_args_list],
+            [
+                f'ssh -o ControlPath="{control_path}" -o ControlMaster=auto '
+                f"-o ControlPersist=600 -o BatchMode=yes -N -f {host}"
+                for host in ["foo1", "foo2"]
+            ],
+        )
+
+        # Panes reuse the connection, while still not becoming a master themselves
+        mec.assert_has_calls(
+            [
+                call(
+                    ANY,
+                    f'unset HISTFILE && exec ssh -o ControlPath="{control_path}" '
+                    f"-o ControlMaster=no {host}\n",
+                )
+                for host in ["foo1", "foo2"]
+            ],
+            any_order=True,
+        )
+
+    def test_prewarm_waits_for_own_master(self, mec: MagicMock):
+        # The connection to foo1 is only up once the session for foo2 has started
+        foo2_started = asyncio.Event()
+        foo1_master = master_process()
+        foo1_master.wait.side_effect = foo2_started.wait
+
+        def execute_command(session, command):
+            if "foo2" in command:
+                foo2_started.set()
+
+        mec.side_effect = execute_command
+        with patch(
+            "asyncio.create_subprocess_shell",
+            side_effect=[foo1_master, master_process()],
+        ), patch("i2cssh.lib.PREWARM_TIMEOUT", 5):
+            started = time.monotonic()
+            invoke(["foo", "--prewarm"], default_config)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIn("foo2", mec.call_args_list[0].args[1])
+        self.assertIn("foo1", mec.call_args_list[1].args[1])
+        foo1_master.kill.assert_not_called()
+
     def test_use_exec_cluster_config(self, mec: MagicMock):
         config = copy.deepcopy(default_config)
         config["clusters"]["foo"]["exec"] = True
@@ -792,6 +2637,22 @@ class TestParams(unittest.TestCase):
         assert_options(mec, "")
         self.assertEqual(mock_sleep.call_count, 2)
 
+    def test_invalid_rate_cli(self, mec: MagicMock):
+        for args in (
+            ["--rate", "-1"],
+            ["--rate", "0"],
+            ["--sleep", "-1"],
+            ["-s", "0"],
+            ["--burst", "0"],
+        ):
+            with patch("i2cssh.lib.read_config", return_value=default_config), patch(
+                "i2cssh.lib.get_window"
+            ), patch("iterm2.run_until_complete", run_until_complete_mock):
+                result = CliRunner().invoke(app, ["foo", *args])
+            self.assertEqual(result.exit_code, 2, args)
+            self.assertIn("Invalid value", result.output)
+        mec.assert_not_called()
+
     @patch("i2cssh.lib.sleep")
     def test_sleep_cluster_config(self, mock_sleep: MagicMock, mec: MagicMock):
         config = copy.deepcopy(default_config)
@@ -814,6 +2675,18 @@ class TestParams(unittest.TestCase):
         assert_options(mec, "")
         mock_lwop.assert_has_calls([call("/usr/bin/env zsh -l")])
 
+    @patch("i2cssh.lib.default_shell", return_value="fish")
+    @patch("i2cssh.lib.create_lwop")
+    def test_shell_default(
+        self, mock_lwop: MagicMock, mock_default_shell: MagicMock, mec: MagicMock
+    ):
+        invoke(["-c", "foo"], default_config)
+        mock_lwop.assert_has_calls([call("/usr/bin/env fish -l")])
+
+        mock_default_shell.reset_mock()
+        invoke(["-c", "foo", "-S", "zsh"], default_config)
+        mock_default_shell.assert_not_called()
+
     @patch("i2cssh.lib.create_lwop")
     def test_shell_cluster_config(self, mock_lwop: MagicMock, mec: MagicMock):
         config = copy.deepcopy(default_config)
@@ -1008,21 +2881,97 @@ class TestParams(unittest.TestCase):
             ]
         )
 
-    @patch("i2cssh.lib.create_unused_pane")
-    def test_direction_column_cluster_config(
-        self, mock_create_unused_pane: MagicMock, mec: MagicMock
+    @patch("i2cssh.lib.create_unused_lwop")
+    @patch("i2cssh.lib.split_pane")
+    def test_uneven_layout(
+        self, mock_split_pane: MagicMock, mock_unused_lwop: MagicMock, mec: MagicMock
     ):
         config = {
             "clusters": {
                 "foo": {
-                    "direction": "column",
                     "hosts": ["foo1", "foo2", "foo3"],
                 },
             },
         }
         invoke(["-c", "foo"], config)
-        assert_options(mec, "")
-        mock_create_unused_pane.assert_called_once()
+        assert_options(mec, "", ["foo1", "foo2", "foo3"])
+        # Split into two rows first, then split the first row into two columns
+        self.assertEqual(mock_split_pane.call_count, 2)
+        mock_split_pane.assert_has_calls(
+            [
+                call("Default", ANY, False, ANY),
+                call("Default", ANY, True, ANY),
+            ]
+        )
+        self.assertEqual(mock_unused_lwop.call_count, 0)
+
+    @patch("i2cssh.lib.create_unused_lwop")
+    @patch("i2cssh.lib.split_pane")
+    def test_fill_unused_cli(
+        self, mock_split_pane: MagicMock, mock_unused_lwop: MagicMock, mec: MagicMock
+    ):
+        config = {
+            "clusters": {
+                "foo": {
+                    "hosts": ["foo1", "foo2", "foo3"],
+                },
+            },
+        }
+        invoke(["-c", "foo", "-U"], config)
+        assert_options(mec, "", ["foo1", "foo2", "foo3"])
+        self.assertEqual(mock_split_pane.call_count, 3)
+        mock_unused_lwop.assert_called_once()
+        self.assertEqual(mec.call_count, 3)
+
+    @patch("i2cssh.lib.split_pane")
+    def test_rows_cli(self, mock_split_pane: MagicMock, mec: MagicMock):
+        config = copy.deepcopy(default_config)
+        config["clusters"]["foo"]["hosts"] = [f"foo{i}" for i in range(1, 8)]
+        invoke(["foo", "-R", "5"], config)
+
+        # 5 rows, of which the first 2 have a second pane
+        self.assertEqual(mock_split_pane.call_count, 6)
+        self.assertEqual(mec.call_count, 7)
+
+    @patch("i2cssh.lib.close_pane")
+    @patch("i2cssh.lib.split_pane")
+    def test_file_stream_cli(
+        self, mock_split_pane: MagicMock, mock_close_pane: MagicMock, mec: MagicMock
+    ):
+        with patch("i2cssh.lib.read_config") as mock_read_config, patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            mock_read_config.return_value = default_config
+            result = CliRunner().invoke(
+                app,
+                ["-f", "-", "--max-hosts", "4", "-r", "-m", "foo1"],
+                input="bar1\n\n# bar\nbar2\n",
+            )
+        assert result.exit_code == 0
+
+        # Panes for foo1 and four hosts from stdin were created up front, the ones without a
+        # host are closed
+        self.assertEqual(mock_split_pane.call_count, 4)
+        self.assertEqual(mock_close_pane.call_count, 2)
+        assert_options(
+            mec,
+            "-o SendEnv=LC_RANK",
+            ["foo1", "bar1", "bar2"],
+            [f"export LC_RANK={p};\n" for p in range(3)],
+        )
+
+    @patch("i2cssh.lib.close_pane")
+    def test_file_stream_no_hosts_cli(self, mock_close_pane: MagicMock, mec: MagicMock):
+        with patch("i2cssh.lib.read_config") as mock_read_config, patch(
+            "i2cssh.lib.get_window"
+        ), patch("iterm2.run_until_complete", run_until_complete_mock):
+            mock_read_config.return_value = default_config
+            result = CliRunner().invoke(
+                app, ["-f", "-", "--max-hosts", "2"], input="# nothing\n"
+            )
+        assert result.exit_code == 255
+        self.assertEqual(mock_close_pane.call_count, 2)
+        self.assertEqual(mec.call_count, 0)
 
     @patch("i2cssh.lib.get_host_strs_from_file")
     def test_file_cli(self, mock_get_host_strs_from_file: MagicMock, mec: MagicMock):